@@ -0,0 +1,308 @@
+"""Benchmarks for the ps6 face pipeline.
+
+Each stage (load_images, pca, convert_images_to_integral_images,
+ViolaJones.train, ViolaJones.predict, ViolaJones.detectMultiScale,
+ViolaJones.faceDetection and group_rectangles) is run on synthetic data,
+timed and profiled with tracemalloc. The results are written as JSON, one
+record per stage, so that runs can be compared with each other.
+
+Example:
+    python benchmark.py --faces 200 --nonfaces 400 --frame 240 320 \
+        --output output/benchmark.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import ps6
+
+
+def synthetic_faces(rng, n, size=(24, 24)):
+    """Return n synthetic face images.
+
+    A face is noise around a mid gray, with darker eyes and mouth, which
+    is enough structure for the Haar features to pick up.
+
+    Args:
+        rng (numpy.random.Generator): Random generator.
+        n (int): Number of images.
+        size (tuple): (rows, cols) of the images.
+
+    Returns:
+        list: uint8 images.
+    """
+    rows, cols = size
+    imgs = rng.normal(120, 25, (n, rows, cols))
+    eyes = slice(rows // 4, rows * 5 // 12)
+    imgs[:, eyes, cols // 6:cols * 5 // 12] -= 15
+    imgs[:, eyes, cols * 7 // 12:cols * 5 // 6] -= 15
+    imgs[:, rows * 2 // 3:rows * 3 // 4, cols // 3:cols * 2 // 3] -= 12
+    return list(np.clip(imgs, 0, 255).astype(np.uint8))
+
+
+def synthetic_nonfaces(rng, n, size=(24, 24)):
+    """Return n noise images of the given (rows, cols) size."""
+    imgs = rng.normal(120, 40, (n,) + tuple(size))
+    return list(np.clip(imgs, 0, 255).astype(np.uint8))
+
+
+def synthetic_frame(rng, shape=(240, 320), num_faces=3, size=(24, 24)):
+    """Return a BGR frame of noise with synthetic faces pasted in it.
+
+    Args:
+        rng (numpy.random.Generator): Random generator.
+        shape (tuple): (rows, cols) of the frame.
+        num_faces (int): Number of faces, each at a random scale between 1
+                         and 3 times size.
+        size (tuple): (rows, cols) of a face at scale 1.
+
+    Returns:
+        numpy.array: uint8 (rows, cols, 3) frame.
+    """
+    frame = synthetic_nonfaces(rng, 1, shape)[0]
+    for face in synthetic_faces(rng, num_faces, size):
+        scale = rng.uniform(1., 3.)
+        face = cv2.resize(face, (int(size[1] * scale), int(size[0] * scale)))
+        if face.shape[0] > shape[0] or face.shape[1] > shape[1]:
+            continue
+        r = rng.integers(0, shape[0] - face.shape[0] + 1)
+        c = rng.integers(0, shape[1] - face.shape[1] + 1)
+        frame[r:r + face.shape[0], c:c + face.shape[1]] = face
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def synthetic_detections(rng, n, shape=(480, 640), size=(24, 24),
+                         per_object=200, scale_factor=1.25):
+    """Return n raw detections clustered around random objects.
+
+    Each object gets per_object detections at its scale and the two
+    neighbouring scales, jittered around its center, the way a cascade
+    fires around a face.
+
+    Args:
+        rng (numpy.random.Generator): Random generator.
+        n (int): Number of detections.
+        shape (tuple): (rows, cols) of the frame.
+        size (tuple): (rows, cols) of a window at scale 1.
+        per_object (int): Detections per object.
+        scale_factor (float): Ratio between two consecutive scales.
+
+    Returns:
+        numpy.array: (n, 4) int array of (x, y, width, height).
+    """
+    objects = max(1, n // per_object)
+    centers = rng.uniform((0, 0), shape[::-1], (objects, 2))
+    levels = rng.integers(0, 6, objects)
+    owner = rng.integers(0, objects, n)
+    scale = scale_factor ** (levels[owner] + rng.integers(-1, 2, n))
+    wh = np.round(np.outer(scale, size[::-1]))
+    xy = centers[owner] + rng.normal(0, 0.15, (n, 2)) * wh - wh / 2
+    return np.hstack((np.round(xy), wh)).astype(int)
+
+
+def write_dataset(folder, imgs, num_subjects=15):
+    """Write images as png files named like the Yale faces.
+
+    The subject label load_images reads from the last two characters of
+    the name cycles through num_subjects values.
+    """
+    for i, img in enumerate(imgs):
+        cv2.imwrite(os.path.join(folder, "img{:05d}_s{:02d}.png".format(
+            i, i % num_subjects + 1)), img)
+
+
+def measure(stage, func, repeat=1, **params):
+    """Time a stage and record its peak traced memory.
+
+    The function runs repeat times. Its printed output goes to stderr so it
+    does not mix with the results.
+
+    Args:
+        stage (str): Stage name.
+        func (callable): Function to run, without arguments.
+        repeat (int): Number of runs.
+        **params: Stage parameters, copied to the record.
+
+    Returns:
+        tuple: two-element tuple containing:
+            record (dict): Stage, params, best and mean seconds and peak
+                           memory in bytes.
+            result: What the last run of func returned.
+    """
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr):
+            result = func()
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    record = {"stage": stage, "params": params, "repeat": repeat,
+              "best_s": min(times), "mean_s": float(np.mean(times)),
+              "peak_bytes": peak}
+    print("{:<24} {:>10.4f} s {:>10.1f} MiB".format(
+        stage, record["best_s"], peak / 2. ** 20), file=sys.stderr)
+    return record, result
+
+
+def run(args):
+    """Run every stage and return the JSON-ready results."""
+    rng = np.random.default_rng(args.seed)
+    size = tuple(args.size)
+    pos = synthetic_faces(rng, args.faces, size)
+    neg = synthetic_nonfaces(rng, args.nonfaces, size)
+    frame = synthetic_frame(rng, tuple(args.frame), args.frame_faces, size)
+    records = []
+
+    workdir = tempfile.mkdtemp(prefix="ps6_benchmark_")
+    try:
+        folder = os.path.join(workdir, "faces")
+        os.makedirs(folder)
+        os.makedirs(os.path.join(workdir, "output"))
+        write_dataset(folder, pos + neg)
+
+        record, _ = measure(
+            "load_images", lambda: ps6.load_images(folder, size),
+            args.repeat, images=len(pos) + len(neg), size=size)
+        records.append(record)
+
+        cache_dir = os.path.join(workdir, "cache")
+        ps6.load_images(folder, size, cache_dir=cache_dir)
+        record, (X, y) = measure(
+            "load_images_cached",
+            lambda: ps6.load_images(folder, size, cache_dir=cache_dir),
+            args.repeat, images=len(pos) + len(neg), size=size)
+        records.append(record)
+
+        X = np.asarray(X, dtype=np.float64)
+        for method in ("covariance", "gram", "randomized"):
+            record, _ = measure(
+                "pca_" + method, lambda: ps6.pca(X, args.k, method),
+                args.repeat, images=len(X), dims=X.shape[1], k=args.k)
+            records.append(record)
+
+        images = pos + neg
+        record, ii = measure(
+            "integral_images",
+            lambda: ps6.convert_images_to_integral_images(images),
+            args.repeat, images=len(images), size=size)
+        records.append(record)
+
+        VJ = ps6.ViolaJones(pos, neg, ii, normalize=args.normalize)
+        VJ.windowShape = size
+        record, _ = measure("create_haar_features", VJ.createHaarFeatures,
+                            args.repeat)
+        record["params"]["features"] = len(VJ.haarFeatures)
+        records.append(record)
+
+        record, _ = measure(
+            "train", lambda: VJ.train(args.classifiers,
+                                      processes=args.processes),
+            1, images=len(images), features=len(VJ.haarFeatures),
+            classifiers=args.classifiers, processes=args.processes,
+            normalize=args.normalize)
+        records.append(record)
+
+        record, _ = measure("predict", lambda: VJ.predict(images),
+                            args.repeat, images=len(images))
+        records.append(record)
+
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        record, faces = measure(
+            "detect_multi_scale",
+            lambda: VJ.detectMultiScale(gray, args.scale_factor,
+                                        args.stride),
+            args.repeat, frame=gray.shape, stride=args.stride,
+            scale_factor=args.scale_factor)
+        record["params"]["detections"] = len(faces)
+        records.append(record)
+
+        rects = synthetic_detections(rng, args.detections, tuple(args.frame),
+                                     size)
+        record, groups = measure(
+            "group_rectangles", lambda: ps6.group_rectangles(rects),
+            args.repeat, detections=len(rects))
+        record["params"]["groups"] = len(groups)
+        records.append(record)
+
+        # faceDetection writes to output/, keep that in the work folder
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            record, _ = measure(
+                "face_detection",
+                lambda: VJ.faceDetection(frame, "benchmark", args.stride,
+                                         args.scale_factor),
+                args.repeat, frame=gray.shape, stride=args.stride,
+                scale_factor=args.scale_factor)
+        finally:
+            os.chdir(cwd)
+        records.append(record)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "seed": args.seed,
+            "stages": records}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--faces", type=int, default=100,
+                        help="number of synthetic faces")
+    parser.add_argument("--nonfaces", type=int, default=200,
+                        help="number of synthetic non-faces")
+    parser.add_argument("--size", type=int, nargs=2, default=(24, 24),
+                        help="rows and cols of the training images")
+    parser.add_argument("--frame", type=int, nargs=2, default=(240, 320),
+                        help="rows and cols of the detection frame")
+    parser.add_argument("--frame-faces", type=int, default=3,
+                        help="number of faces pasted in the frame")
+    parser.add_argument("--k", type=int, default=10,
+                        help="number of PCA components")
+    parser.add_argument("--classifiers", type=int, default=5,
+                        help="number of weak classifiers to train")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="training search processes")
+    parser.add_argument("--normalize", action="store_true",
+                        help="train a variance normalized detector")
+    parser.add_argument("--stride", type=int, default=1,
+                        help="detection stride")
+    parser.add_argument("--scale-factor", type=float, default=1.25,
+                        help="detection scale factor")
+    parser.add_argument("--detections", type=int, default=50000,
+                        help="number of raw detections to group")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per stage, the best time is kept")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed of the synthetic data")
+    parser.add_argument("--output", default="-",
+                        help="JSON output file, - for stdout")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run(args)
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
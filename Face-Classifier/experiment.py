@@ -111,21 +111,11 @@ def part_1c():
     mu = ps6.get_mean_face(Xtest)
     Xtest_proj = np.dot(Xtest - mu, eig_vecs)
 
-    good = 0
-    bad = 0
+    matcher = ps6.FaceMatcher(Xtrain_proj, ytrain)
+    y_pred = matcher.predict(Xtest_proj)
 
-    for i, obs in enumerate(Xtest_proj):
-
-        dist = [np.linalg.norm(obs - x) for x in Xtrain_proj]
-
-        idx = np.argmin(dist)
-        y_pred = ytrain[idx]
-
-        if y_pred == ytest[i]:
-            good += 1
-
-        else:
-            bad += 1
+    good = int(np.sum(y_pred == ytest))
+    bad = len(ytest) - good
 
     print('Good predictions = ', good, 'Bad predictions = ', bad)
     print('{0:.2f}% accuracy'.format(100 * float(good) / (good + bad)))
@@ -3,47 +3,100 @@ import numpy as np
 import cv2
 import os
 import math
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
 
 from helper_classes import WeakClassifier, VJ_Classifier
 
 
 # assignment code
-def load_images(folder, size=(32, 32)):
+def _image_files(folder):
+    """Return the sorted names of the png images in a folder."""
+    return sorted(f for f in os.listdir(folder) if f.endswith(".png"))
+
+
+def _image_label(frame):
+    """Return the subject label encoded in an image file name."""
+    return int(frame.split('.')[0][-2:])
+
+
+def _read_image(path, size):
+    """Read an image as a flattened grayscale array of a given size."""
+    img = cv2.imread(path)
+    img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(img_gray, tuple(size)).flatten()
+
+
+def _images_cache_key(folder, images_files, size):
+    """Return a key that changes with the folder contents or the size."""
+    digest = hashlib.sha1(repr(tuple(size)).encode())
+    for frame in sorted(images_files):
+        st = os.stat(os.path.join(folder, frame))
+        digest.update("{}:{}:{}\n".format(frame, st.st_size,
+                                          st.st_mtime_ns).encode())
+    return digest.hexdigest()[:16]
+
+
+def load_images(folder, size=(32, 32), cache_dir=None, processes=None):
     """Load images to workspace.
 
+    Images are decoded in a process pool, in the sorted order of their
+    names. When a cache_dir is given, the data matrix and labels are then
+    saved as .npy files in it, under a key made from the image names,
+    sizes and modification times and the target size. Later calls with
+    the same folder contents and size memory-map the cached matrix copy
+    on write instead of decoding anything.
+
     Args:
         folder (String): path to folder with images.
         size   (tuple): new image sizes
+        cache_dir (String): folder for the cache files. Defaults to None,
+                            which disables caching.
+        processes (int): number of decoding processes. Defaults to the
+                         number of CPUs, 1 decodes in this process.
 
     Returns:
         tuple: two-element tuple containing:
             X (numpy.array): data matrix of flatten images
-                             (row:observations, col:features) (float).
+                             (row:observations, col:features) (uint8).
             y (numpy.array): 1D array of labels (int).
     """
 
-    images_files = [f for f in os.listdir(folder) if f.endswith(".png")]
-    img_number = len(images_files)
-    X,y = [],[]
-    for frame in images_files:
-    	img = cv2.imread(os.path.join(folder, frame))
-    	img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    	# cv2.imshow('temp',img)
-    	# cv2.waitKey(0)
-    	# print(size)
-    	size = tuple(size)
-    	img_small = cv2.resize(img_gray, size)
-    	# print(img_small.shape)
-    	img_flat = img_small.flatten()
-    	# print(img_flat.shape)
-    	X.append(img_flat)
-    	# print(np.shape(X))
-    	label_temp = frame.split('.')[0][-2:]
-    	# print(int(label_temp))
-    	y.append(int(label_temp))
-    X = np.asarray(X)
-    y = np.asarray(y)
-    return (X,y)
+    images_files = _image_files(folder)
+
+    if cache_dir:
+        key = _images_cache_key(folder, images_files, size)
+        x_path = os.path.join(cache_dir, "images_{}.npy".format(key))
+        y_path = os.path.join(cache_dir, "labels_{}.npy".format(key))
+        if os.path.exists(x_path) and os.path.exists(y_path):
+            return (np.load(x_path, mmap_mode='c'), np.load(y_path))
+
+    paths = [os.path.join(folder, frame) for frame in images_files]
+    args = [(path, tuple(size)) for path in paths]
+    if processes == 1 or len(paths) < 2:
+        X = [_read_image(*arg) for arg in args]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            X = pool.starmap(_read_image, args, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+    X = np.asarray(X, dtype=np.uint8).reshape(len(paths), size[0] * size[1])
+    y = np.asarray([_image_label(frame) for frame in images_files])
+
+    if not cache_dir:
+        return (X,y)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write under temporary names so an interrupted run leaves no cache
+    for path, data in ((y_path, y), (x_path, X)):
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, data)
+        os.replace(path + ".tmp", path)
+    return (np.load(x_path, mmap_mode='c'), y)
     # raise NotImplementedError
 
 
@@ -98,17 +151,61 @@ def get_mean_face(x):
 
 
 
-def pca(X, k):
+def _randomized_svd(C, k, oversample=10, n_iter=4):
+    """Return the top k singular values and right singular vectors of C.
+
+    Randomized range finder: C is multiplied by a random block of k +
+    oversample vectors, a few power iterations sharpen the spectrum, and
+    the exact SVD is taken of the small projection of C on that range.
+
+    Args:
+        C (numpy.array): 2D data array.
+        k (int): Number of singular values.
+        oversample (int): Extra random vectors for accuracy.
+        n_iter (int): Number of power iterations.
+
+    Returns:
+        tuple: (k, ) singular values and (D, k) right singular vectors.
+    """
+    m = min(k + oversample, min(C.shape))
+    Y = np.dot(C, np.random.standard_normal((C.shape[1], m)).astype(C.dtype))
+    for _ in range(n_iter):
+        Y, _ = np.linalg.qr(Y)
+        Z, _ = np.linalg.qr(np.dot(C.T, Y))
+        Y = np.dot(C, Z)
+    Q, _ = np.linalg.qr(Y)
+    _, s, Vt = np.linalg.svd(np.dot(Q.T, C), full_matrices=False)
+    return s[:k], Vt[:k].T
+
+
+def pca(X, k, method='auto', dtype=np.float64):
     """PCA Reduction method.
 
     Return the top k eigenvectors and eigenvalues using the covariance array
     obtained from X.
 
+    The eigenvalues are those of the scatter matrix C^T C of the centered
+    data C (D x D for D pixels). Forming it is only needed when there are
+    fewer pixels than images:
+
+    - 'covariance': eigendecomposition of the D x D scatter matrix.
+    - 'gram': eigendecomposition of the N x N Gram matrix C C^T, which has
+      the same nonzero eigenvalues. Its eigenvectors u map to the scatter
+      matrix eigenvectors C^T u / sqrt(eigenvalue). The centered data has
+      rank at most N - 1, so 'covariance' is used instead when k >= N,
+      to still return k components.
+    - 'randomized': randomized truncated SVD of C, which only computes the
+      top k components.
+    - 'auto': 'randomized' when k is small next to a large min(N, D),
+      otherwise the smaller of 'gram' and 'covariance'.
 
     Args:
         X (numpy.array): 2D data array of flatten images (row:observations,
                          col:features) (float).
         k (int): new dimension space
+        method (str): 'auto', 'covariance', 'gram' or 'randomized'.
+        dtype (numpy.dtype): Computation type, np.float32 halves the
+                             memory used. Defaults to np.float64.
 
     Returns:
         tuple: two-element tuple containing
@@ -117,23 +214,357 @@ def pca(X, k):
     """
 
     # raise NotImplementedError
+    X = np.asarray(X, dtype=dtype)
+    N, D = X.shape
+    if method == 'auto':
+        if min(N, D) > 1000 and k < min(N, D) // 10:
+            method = 'randomized'
+        elif N < D:
+            method = 'gram'
+        else:
+            method = 'covariance'
+    if method == 'gram' and k >= N:
+        method = 'covariance'
+
     M = get_mean_face(X)
     C = X - M
-    V = np.cov(C.transpose(), bias=True)
-    V = V * X.shape[0]
-    values,vectors = np.linalg.eigh(V)
-    idx = values.argsort()[::-1] 
-    evalues = values[idx]
-    evectors = vectors[:,idx]
-    # print(np.shape(evectors))
-    # eigenvectors = np.dot(C,evectors)
-    eigenvalues = evalues[:k]
-    eigenvectors = evectors[:,:k]
-    # norms = np.linalg.norm(eigenvectors,axis=0)
-    # eigenvectors = eigenvectors / norms
+
+    if method == 'randomized':
+        s, eigenvectors = _randomized_svd(C, k)
+        return (eigenvectors, s ** 2)
+
+    if method == 'gram':
+        values, vectors = np.linalg.eigh(np.dot(C, C.T))
+    elif method == 'covariance':
+        values, vectors = np.linalg.eigh(np.dot(C.T, C))
+    else:
+        raise ValueError("Unknown PCA method '{}'".format(method))
+
+    idx = values.argsort()[::-1][:k]
+    eigenvalues = values[idx]
+    eigenvectors = vectors[:, idx]
+    if method == 'gram':
+        eigenvectors = np.dot(C.T, eigenvectors)
+        norms = np.linalg.norm(eigenvectors, axis=0)
+        eigenvectors /= np.where(norms > 0, norms, 1)
     return (eigenvectors,eigenvalues)
 
 
+def iter_image_batches(folder, size=(32, 32), batch_size=100):
+    """Load the images of a folder a batch at a time.
+
+    Images are read, converted and labeled like in load_images, but only
+    batch_size of them are held in memory at once.
+
+    Args:
+        folder (String): path to folder with images.
+        size (tuple): new image sizes
+        batch_size (int): number of images per batch.
+
+    Yields:
+        tuple: two-element tuple containing:
+            X (numpy.array): data matrix of flatten images (float).
+            y (numpy.array): 1D array of labels (int).
+    """
+    images_files = _image_files(folder)
+    for start in range(0, len(images_files), batch_size):
+        batch = images_files[start:start + batch_size]
+        X = [_read_image(os.path.join(folder, frame), size) for frame in batch]
+        y = [_image_label(frame) for frame in batch]
+        yield (np.asarray(X, dtype=np.float64), np.asarray(y))
+
+
+class IncrementalPCA:
+    """PCA fitted one batch of images at a time.
+
+    The basis is kept as the top k singular values and right singular
+    vectors of the centered data seen so far. Each batch is centered on its
+    own mean and stacked under the current basis (scaled by its singular
+    values) and a row that corrects for the shift between the two means,
+    and the SVD of that small stack gives the updated basis. Images seen
+    before are never needed again, so the basis can be updated with new
+    enrollments as they come.
+
+    The eigenvalues have the same scale as the ones returned by pca.
+
+    Args:
+        k (int): Number of components to keep.
+
+    Attributes:
+        k (int): Number of components to keep.
+        num_obs (int): Number of observations seen so far.
+        mean_face (numpy.array): Mean of the observations seen so far.
+        eigenvectors (numpy.array): (D, k) array with the top k
+                                    eigenvectors.
+        eigenvalues (numpy.array): Array with the top k eigenvalues.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.num_obs = 0
+        self.mean_face = None
+        self.eigenvectors = None
+        self.eigenvalues = None
+
+    def partial_fit(self, X):
+        """Update the mean face and the basis with a batch of images.
+
+        Args:
+            X (numpy.array): 2D data array of flatten images
+                             (row:observations, col:features) (float).
+
+        Returns:
+            IncrementalPCA: self.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        n = len(X)
+        if not n:
+            return self
+        batch_mean = get_mean_face(X)
+        C = X - batch_mean
+
+        if self.num_obs:
+            total = self.num_obs + n
+            correction = np.sqrt(float(self.num_obs) * n / total) * (
+                self.mean_face - batch_mean)
+            C = np.vstack((np.sqrt(self.eigenvalues)[:, None] *
+                           self.eigenvectors.T, C, correction))
+            self.mean_face = self.mean_face + (batch_mean -
+                                               self.mean_face) * n / total
+        else:
+            self.mean_face = batch_mean
+
+        _, s, Vt = np.linalg.svd(C, full_matrices=False)
+        self.eigenvectors = Vt[:self.k].T
+        self.eigenvalues = s[:self.k] ** 2
+        self.num_obs += n
+        return self
+
+    def fit(self, batches):
+        """Update the basis with every batch of an iterable.
+
+        Args:
+            batches (iterable): Data arrays, or (X, y) tuples as yielded
+                                by iter_image_batches.
+
+        Returns:
+            IncrementalPCA: self.
+        """
+        for batch in batches:
+            if isinstance(batch, tuple):
+                batch = batch[0]
+            self.partial_fit(batch)
+        return self
+
+
+class FaceMatcher:
+    """Nearest neighbour search over a gallery of projected faces.
+
+    Gallery vectors are stored in one contiguous array with their squared
+    norms. Squared distances between a block of queries and the whole
+    gallery come from a single matrix product,
+    |q - g|^2 = |q|^2 - 2 q.g + |g|^2, and queries are processed in chunks
+    so the distance block stays below max_block entries.
+
+    For low dimensional projections an exact kd-tree (cv2.flann_Index with
+    unlimited checks) can be used instead; it is built on first use and
+    rebuilt after new enrollments.
+
+    Args:
+        X (numpy.array): Gallery of projected faces (row:observations,
+                         col:features).
+        y (numpy.array): Labels, one for each row in X.
+        use_tree (bool): Search with a kd-tree. Defaults to False.
+        max_block (int): Maximum number of entries of a distance block.
+
+    Attributes:
+        gallery (numpy.array): Contiguous array of gallery vectors.
+        labels (numpy.array): Gallery labels.
+        sq_norms (numpy.array): Squared norm of each gallery vector.
+        use_tree (bool): Whether queries go through the kd-tree.
+        max_block (int): Maximum number of entries of a distance block.
+    """
+
+    def __init__(self, X, y, use_tree=False, max_block=2 ** 24):
+        self.gallery = np.ascontiguousarray(X, dtype=np.float64)
+        self.labels = np.asarray(y)
+        self.sq_norms = np.einsum('ij,ij->i', self.gallery, self.gallery)
+        self.use_tree = use_tree
+        self.max_block = max_block
+        self._tree = None
+
+    def add(self, X, y):
+        """Enroll more faces in the gallery.
+
+        Args:
+            X (numpy.array): Projected faces.
+            y (numpy.array): Labels, one for each row in X.
+        """
+        X = np.asarray(X, dtype=np.float64).reshape(-1, self.gallery.shape[1])
+        self.gallery = np.vstack((self.gallery, X))
+        self.labels = np.hstack((self.labels, y))
+        self.sq_norms = np.hstack((self.sq_norms, np.einsum('ij,ij->i', X, X)))
+        self._tree = None
+
+    def kneighbors(self, X, n_neighbors=1):
+        """Return the nearest gallery faces of every query.
+
+        Args:
+            X (numpy.array): Projected queries (row:observations).
+            n_neighbors (int): Number of neighbours per query.
+
+        Returns:
+            tuple: two-element tuple containing:
+                distances (numpy.array): (queries, n_neighbors) Euclidean
+                                         distances, closest first.
+                indices (numpy.array): (queries, n_neighbors) gallery rows.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=np.float64))
+        n_neighbors = min(n_neighbors, len(self.gallery))
+
+        if self.use_tree:
+            if self._tree is None:
+                self._tree = cv2.flann_Index(
+                    np.float32(self.gallery),
+                    dict(algorithm=4, leaf_max_size=10))  # single kd-tree
+            indices, sq_dist = self._tree.knnSearch(
+                np.float32(X), n_neighbors, params=dict(checks=-1))
+            return (np.sqrt(sq_dist.astype(np.float64)),
+                    indices.astype(np.intp))
+
+        distances = np.empty((len(X), n_neighbors))
+        indices = np.empty((len(X), n_neighbors), dtype=np.intp)
+        chunk = max(1, self.max_block // max(len(self.gallery), 1))
+        for start in range(0, len(X), chunk):
+            Q = X[start:start + chunk]
+            sq_dist = np.dot(Q, self.gallery.T)
+            sq_dist *= -2
+            sq_dist += self.sq_norms
+            sq_dist += np.einsum('ij,ij->i', Q, Q)[:, None]
+            if n_neighbors == 1:
+                part = np.argmin(sq_dist, axis=1)[:, None]
+            elif n_neighbors < len(self.gallery):
+                part = np.argpartition(sq_dist, n_neighbors - 1,
+                                       axis=1)[:, :n_neighbors]
+            else:
+                part = np.broadcast_to(np.arange(len(self.gallery)),
+                                       sq_dist.shape)
+            part_dist = np.take_along_axis(sq_dist, part, 1)
+            order = np.argsort(part_dist, axis=1, kind='stable')
+            indices[start:start + chunk] = np.take_along_axis(part, order, 1)
+            distances[start:start + chunk] = np.sqrt(np.maximum(
+                np.take_along_axis(part_dist, order, 1), 0))
+        return distances, indices
+
+    def predict(self, X):
+        """Return the label of the nearest gallery face of every query.
+
+        Args:
+            X (numpy.array): Projected queries (row:observations).
+
+        Returns:
+            numpy.array: Predicted labels, one for each row in X.
+        """
+        _, indices = self.kneighbors(X, 1)
+        return self.labels[indices[:, 0]]
+
+
+class StumpSearch:
+    """Weighted decision stump search over pre-sorted feature columns.
+
+    Every column of X is argsorted once. For a given set of weights the
+    cumulative sum of the signed weights (weight * label) down a sorted
+    column gives, for every split point at once, the weighted error of
+    both stump polarities:
+
+        error(+1) = W+ - cumsum    (x < threshold is labeled +1)
+        error(-1) = W- + cumsum    (x < threshold is labeled -1)
+
+    so each boosting round costs O(N F) instead of one pass over the data
+    per candidate threshold.
+
+    Args:
+        X (numpy.array): Data array (row:observations, col:features).
+        y (numpy.array): Labels array of shape (observations, ), +1 or -1.
+        order (numpy.array): Optional precomputed argsort of X's columns.
+        split_ok (numpy.array): Optional precomputed split_ok of X and
+                                order, which does not depend on the
+                                weights.
+
+    Attributes:
+        X (numpy.array): Data array.
+        y (numpy.array): Labels array.
+        order (numpy.array): Row order that sorts each column of X.
+        split_ok (numpy.array): (observations - 1, features) boolean array,
+                                True where a threshold can be placed between
+                                two consecutive sorted values.
+    """
+
+    def __init__(self, X, y, order=None, split_ok=None):
+        self.X = X
+        self.y = np.asarray(y)
+        if order is None:
+            idx_type = np.int32 if len(X) < 2 ** 31 else np.intp
+            order = np.argsort(X, axis=0, kind='stable').astype(idx_type)
+        self.order = order
+        if split_ok is None:
+            split_ok = np.diff(np.take_along_axis(X, self.order, 0),
+                               axis=0) > 0
+        self.split_ok = split_ok
+
+    def best(self, weights):
+        """Return the stump with the lowest weighted error.
+
+        Args:
+            weights (numpy.array): Array of weights, one for each
+                                   observation.
+
+        Returns:
+            tuple: four-element tuple containing:
+                feature (int): Column id in X.
+                threshold (float): Threshold between two observed values.
+                polarity (int): 1 if observations below the threshold are
+                                labeled 1, -1 otherwise.
+                error (float): Weighted error of the stump.
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+        total_pos = np.sum(weights[self.y > 0])
+        total_neg = np.sum(weights[self.y < 0])
+
+        cum = np.cumsum((weights * self.y)[self.order[:-1]], axis=0)
+        hi = np.where(self.split_ok, cum, -np.inf)
+        lo = np.where(self.split_ok, cum, np.inf)
+        # Best split of each feature, then the first feature with the
+        # lowest error, so ties do not depend on how columns are blocked.
+        err_pos = total_pos - np.max(hi, axis=0, initial=-np.inf)
+        err_neg = total_neg + np.min(lo, axis=0, initial=np.inf)
+        f_pos = int(np.argmin(err_pos))
+        f_neg = int(np.argmin(err_neg))
+        if not np.isfinite(min(err_pos[f_pos], err_neg[f_neg])):
+            raise ValueError("Every feature is constant, no split exists.")
+
+        if err_pos[f_pos] <= err_neg[f_neg]:
+            feature, polarity, error = f_pos, 1, err_pos[f_pos]
+            row = np.argmax(hi[:, feature])
+        else:
+            feature, polarity, error = f_neg, -1, err_neg[f_neg]
+            row = np.argmin(lo[:, feature])
+        threshold = 0.5 * (self.X[self.order[row, feature], feature] +
+                           self.X[self.order[row + 1, feature], feature])
+        return (int(feature), float(threshold), polarity, float(error))
+
+
+# Version of the .npz layout written by Boosting.save and ViolaJones.save
+MODEL_VERSION = 1
+
+
+def _check_model_version(model, filename):
+    """Raise a ValueError unless a loaded model has a known layout."""
+    if "version" not in model or int(model["version"]) != MODEL_VERSION:
+        raise ValueError("{} is not a version {} model file.".format(
+            filename, MODEL_VERSION))
+
+
 class Boosting:
     """Boosting classifier.
 
@@ -165,36 +596,32 @@ class Boosting:
         self.weakClassifiers = []
         self.alphas = []
         self.num_obs,_ = np.shape(X)
-        self.weights = np.array([1.0 / self.num_obs] * self.num_obs)  # uniform weights
+        self.weights = np.ones(self.num_obs) / self.num_obs  # uniform weights
         self.eps = 0.0001
         
     def train(self):
         """Implement the for loop shown in the problem set instructions."""
         # raise NotImplementedError
+        search = StumpSearch(self.Xtrain, self.ytrain)
         for j in range(self.num_iterations):
-        	sum_temp = np.sum(self.weights)
-        	self.weights = self.weights / sum_temp
-        	eps_temp = 0
-        	wkc = WeakClassifier(self.Xtrain, self.ytrain, self.weights, self.eps)
-        	wkc.train()
-        	# self.weakClassifiers = (self.wkc.predict(self.Xtrain))
-        	# print(np.shape(self.Xtrain))
-        	predict_temp = []
-        	for i in range(self.num_obs):
-	        	predict_temp.append(wkc.predict(self.Xtrain[i]))
-	        	index = self.ytrain[i] != predict_temp[i]
-	        	eps_temp += index * self.weights[i]
-	        self.weakClassifiers.append(wkc)
-	        # print(np.shape(self.weakClassifiers))
-	        self.alphas.append(0.5 * math.log((1.-eps_temp)/eps_temp))
-	        # print(np.shape(self.weakClassifiers))
-	        if eps_temp >= self.eps:
-	        	for i in range(self.num_obs):
-	        		self.weights[i] = self.weights[i] * math.exp((-1) * self.ytrain[i]*self.alphas[j]*wkc.predict(self.Xtrain[i]))
-	        else:
-	        	break
-
-
+            self.weights = self.weights / np.sum(self.weights)
+            feat, thresh, polarity, eps_temp = search.best(self.weights)
+            # WeakClassifier labels x > thresh with its sign, the search
+            # labels x < thresh with the polarity. Thresholds never fall on
+            # a training value, so flipping the sign gives the same stump.
+            wkc = WeakClassifier(self.Xtrain[:0], self.ytrain[:0],
+                                 self.weights[:0], thresh, feat, -polarity)
+            predict_temp = -polarity * np.where(
+                self.Xtrain[:, feat] > thresh, 1., -1.)
+            self.weakClassifiers.append(wkc)
+            # a perfect stump would make alpha infinite
+            eps_temp = max(eps_temp, 1e-10)
+            self.alphas.append(0.5 * math.log((1.-eps_temp)/eps_temp))
+            if eps_temp >= self.eps:
+                self.weights = self.weights * np.exp(
+                    -self.ytrain * self.alphas[j] * predict_temp)
+            else:
+                break
 
     def evaluate(self):
         """Return the number of correct and incorrect predictions.
@@ -209,43 +636,93 @@ class Boosting:
                 incorrect (int): Number of incorrect predictions.
         """
         # raise NotImplementedError
-        corr = 0
-        inco = 0
-        # self.train()
-        # print(np.shape(self.weakClassifiers),np.shape(self.Xtrain))
         temp_y = self.predict(self.Xtrain)
-        for i in range(self.num_obs):
-        	if temp_y[i] == self.ytrain[i]: corr += 1
-        	else: inco += 1 
-        return (corr,inco)
+        corr = int(np.sum(temp_y == self.ytrain))
+        return (corr, self.num_obs - corr)
 
+    def compile(self):
+        """Return the ensemble as parallel arrays.
 
-    def predict(self, X):
+        Returns:
+            tuple: four-element tuple containing:
+                features (numpy.array): Column used by each weak classifier.
+                thresholds (numpy.array): Threshold of each weak classifier.
+                signs (numpy.array): Sign of each weak classifier.
+                alphas (numpy.array): Alpha of each weak classifier.
+        """
+        wkcs = self.weakClassifiers[:len(self.alphas)]
+        return (np.array([wkc.feature for wkc in wkcs], dtype=np.intp),
+                np.array([wkc.threshold for wkc in wkcs], dtype=np.float64),
+                np.array([wkc.sign for wkc in wkcs], dtype=np.float64),
+                np.array(self.alphas, dtype=np.float64))
+
+    def predict(self, X, chunk_size=65536):
         """Return predictions for a given array of observations.
 
         Use the alpha values stored in self.aphas and the weak classifiers
         stored in self.weakClassifiers.
 
+        The ensemble is compiled to parallel arrays, so a chunk of
+        observations is classified by every weak classifier with one
+        comparison and the votes are weighted with one dot product.
+
         Args:
             X (numpy.array): Array of flattened images (observations).
+            chunk_size (int): Number of observations classified at a time.
 
         Returns:
             numpy.array: Predictions, one for each row in X.
         """
         # raise NotImplementedError
-        values = []
-        for j in range(len(self.alphas)):
-        	predict_temp = []
-        	for i in range(X.shape[0]):
-        		x_temp = X[i,:]
-        		predict_temp.append(self.weakClassifiers[j].predict(x_temp))
-        	predict_temp = np.asarray(predict_temp)
-        	# print(np.shape(predict_temp))
-        	values.append(self.alphas[j]*predict_temp)
-        out = np.sign(np.sum(values, axis=0))
-        out = np.asarray(out.copy())
+        features, thresholds, signs, alphas = self.compile()
+        out = np.empty(len(X))
+        for start in range(0, len(X), chunk_size):
+            votes = np.where(X[start:start + chunk_size, features] > thresholds,
+                             signs, -signs)
+            out[start:start + chunk_size] = np.sign(np.dot(votes, alphas))
         return out
 
+    def save(self, filename):
+        """Save the trained ensemble to an .npz file.
+
+        Only the compiled arrays are stored, not the training data. The file
+        is written under filename as given, without adding .npz to it.
+
+        Args:
+            filename (str): Output file name.
+        """
+        features, thresholds, signs, alphas = self.compile()
+        with open(filename, "wb") as f:
+            np.savez(f, version=MODEL_VERSION, features=features,
+                     thresholds=thresholds, signs=signs, alphas=alphas,
+                     num_columns=self.Xtrain.shape[1])
+
+    @classmethod
+    def load(cls, filename):
+        """Load an ensemble saved with Boosting.save.
+
+        The returned classifier has no training data, it can predict but
+        not be trained or evaluated.
+
+        Args:
+            filename (str): Model file name.
+
+        Returns:
+            Boosting: Trained classifier.
+        """
+        with np.load(filename, allow_pickle=False) as model:
+            _check_model_version(model, filename)
+            boost = cls(np.zeros((0, int(model["num_columns"]))),
+                        np.zeros(0), len(model["alphas"]))
+            for feat, thresh, sign in zip(model["features"].tolist(),
+                                          model["thresholds"].tolist(),
+                                          model["signs"].tolist()):
+                boost.weakClassifiers.append(WeakClassifier(
+                    boost.Xtrain, boost.ytrain, boost.weights, thresh, feat,
+                    sign))
+            boost.alphas = model["alphas"].tolist()
+        return boost
+
 
 class HaarFeature:
     """Haar-like features.
@@ -373,6 +850,45 @@ class HaarFeature:
 
         # raise NotImplementedError
 
+    def _rectangles(self):
+        """Return the feature's rectangles and their signs.
+
+        The rectangles follow the same split used in evaluate so that a
+        score can be rebuilt as the signed sum of the rectangle sums.
+
+        Returns:
+            list: (row, col, height, width, sign) tuples.
+        """
+        (r, c) = self.position
+        (h, w) = self.size
+
+        if self.feat_type == (2, 1):  # two_horizontal
+            sh = h // 2
+            return [(r, c, sh, w, 1), (r + sh, c, h - sh, w, -1)]
+
+        if self.feat_type == (1, 2):  # two_vertical
+            sw = w // 2
+            return [(r, c, h, sw, 1), (r, c + sw, h, w - sw, -1)]
+
+        if self.feat_type == (3, 1):  # three_horizontal
+            sh = h // 3
+            return [(r, c, sh, w, 1), (r + sh, c, sh, w, -1),
+                    (r + 2 * sh, c, h - 2 * sh, w, 1)]
+
+        if self.feat_type == (1, 3):  # three_vertical
+            sw = w // 3
+            return [(r, c, h, sw, 1), (r, c + sw, h, sw, -1),
+                    (r, c + 2 * sw, h, w - 2 * sw, 1)]
+
+        if self.feat_type == (2, 2):  # four_square
+            sh = h // 2
+            sw = w // 2
+            return [(r, c, sh, sw, -1), (r, c + sw, sh, w - sw, 1),
+                    (r + sh, c, h - sh, sw, 1),
+                    (r + sh, c + sw, h - sh, w - sw, -1)]
+
+        raise ValueError("Unknown feature type {}".format(self.feat_type))
+
     def preview(self, shape=(24, 24), filename=None):
         """Return an image with a Haar-like feature of a given type.
 
@@ -414,7 +930,7 @@ class HaarFeature:
 
         return X
 
-    def evaluate(self, ii):
+    def evaluate(self, ii, sq_ii=None):
         """Evaluates a feature's score on a given integral image.
 
         Calculate the score of a feature defined by the self.feat_type.
@@ -429,116 +945,933 @@ class HaarFeature:
         method and not numpy.sum(). This will make this process faster and
         will be useful in the ViolaJones algorithm.
 
+        When the squared integral image is given, the score is variance
+        normalized like in HaarFeatureBank: the mean and standard deviation
+        of the whole image are read from the two integral images in O(1).
+
         Args:
-            ii (numpy.array): Integral Image.
+            ii (numpy.array): Integral Image, as returned by
+                              convert_images_to_integral_images.
+            sq_ii (numpy.array): Optional integral image of the squared
+                                 image.
 
         Returns:
             float: Score value.
         """
 
         # raise NotImplementedError
-        ii = ii.astype(np.float32)
-        (r,c) = self.position
-       	(h,w) = self.size
-        if self.feat_type == (2, 1):  # two_horizontal
-        	sh = self.size[0] // 2
-        	A = ii[r-1][c-1]
-        	B = ii[r-1][c+w-1]
-        	C = ii[r+sh-1][c-1]
-        	D = ii[r+sh-1][c+w-1]
-        	sum1 = A + D - B - C
-        	E = ii[r+h-1][c-1]
-        	F = ii[r+h-1][c+w-1]
-        	sum2 = C + F - E - D 
-        	return (sum1 - sum2)
+        ii = np.asarray(ii)
+        score = 0.
+        area = 0
+        for (r, c, h, w, s) in self._rectangles():
+            score += s * _rect_sum(ii, r, c, (h, w))
+            area += s * h * w
+        if sq_ii is None:
+            return float(score)
+
+        window = (ii.shape[0] - 1, ii.shape[1] - 1)
+        score = _normalize_scores(np.array([score], dtype=np.float64),
+                                  np.array([area]), ii[-1, -1],
+                                  np.asarray(sq_ii)[-1, -1],
+                                  window[0] * window[1])
+        return float(score[0])
+
+
+def convert_images_to_integral_images(images, dtype=np.float64, out=None):
+    """Convert a list of grayscale images to integral images.
 
-        if self.feat_type == (1, 2):  # two_vertical
-        	sw = self.size[1] // 2
-        	A = ii[r-1][c-1]
-        	B = ii[r-1][c+sw-1]
-        	C = ii[r+h-1][c-1]
-        	D = ii[r+h-1][c+sw-1]
-        	sum1 = A + D - B - C
-        	E = ii[r-1][c+w-1]
-        	F = ii[r+h-1][c+w-1]
-        	sum2 = B + F - E - D
-        	return (sum1 - sum2)
-            
+    The whole stack is accumulated at once with two cumulative sums. Every
+    integral image is padded with a leading row and column of zeros, so the
+    sum of a rectangle with top left corner (r, c) and size (h, w) is
+    ii[r+h, c+w] - ii[r, c+w] - ii[r+h, c] + ii[r, c] for any position,
+    including the image borders.
 
-        if self.feat_type == (3, 1):  # three_horizontal
-        	sh = self.size[0] // 3
-        	A = ii[r-1][c-1]
-        	B = ii[r-1][c+w-1]
-        	C = ii[r+sh-1][c-1]
-        	D = ii[r+sh-1][c+w-1]
-        	sum1 = A + D - B - C
-        	E = ii[r+sh+sh-1][c-1]
-        	F = ii[r+sh+sh-1][c+w-1]
-        	sum2 = C + F - E - D 
-        	G = ii[r+h-1][c-1]
-        	H = ii[r+h-1][c+w-1]
-        	sum3 = E + H - F - G
-        	return (sum1 - sum2 + sum3)
-            
+    Args:
+        images (list): List of grayscale images (uint8 or float) or a
+                       (N, H, W) array.
+        dtype (numpy.dtype): Accumulation type, np.float64 (default) or
+                             np.int64. Ignored when out is given.
+        out (numpy.array): Optional C-contiguous (N, H+1, W+1) buffer the
+                           integral images are written to.
 
-        if self.feat_type == (1, 3):  # three_vertical
-        	sw = self.size[1] // 3
-        	A = ii[r-1][c-1]
-        	B = ii[r-1][c+sw-1]
-        	C = ii[r+h-1][c-1]
-        	D = ii[r+h-1][c+sw-1]
-        	sum1 = A + D - B - C
-        	E = ii[r-1][c+sw+sw-1]
-        	F = ii[r+h-1][c+sw+sw-1]
-        	sum2 = B + F - E - D
-        	G = ii[r-1][c+w-1]
-        	H = ii[r+h-1][c+w-1]
-        	sum3 = E + H - G - F
-        	return (sum1 - sum2 + sum3)
-            
+    Returns:
+        numpy.array: (N, H+1, W+1) array of integral images.
+    """
 
-        if self.feat_type == (2, 2):  # four_square
-        	sw = self.size[1] // 2
-        	sh = self.size[0] // 2
-        	A = ii[r-1][c-1]
-        	B = ii[r-1][c+sw-1]
-        	C = ii[r+sh-1][c-1]
-        	D = ii[r+sh-1][c+sw-1]
-        	sum1 = A + D - B - C
-        	E = ii[r-1][c+w-1]
-        	F = ii[r+sh-1][c+w-1]
-        	sum2 = B + F - E - D
-        	G = ii[r+h-1][c-1]
-        	H = ii[r+h-1][c+sw-1]
-        	sum3 = C + H - D - G
-        	I = ii[r+h-1][c+w-1]
-        	sum4 = D + I - F - H
-        	return (sum2 + sum3 - sum1 - sum4)
-            
-
-
-def convert_images_to_integral_images(images):
-    """Convert a list of grayscale images to integral images.
+    images = np.asarray(images)
+    img_num, H, W = np.shape(images)
+    if out is None:
+        out = np.empty((img_num, H + 1, W + 1), dtype=dtype)
+    elif out.shape != (img_num, H + 1, W + 1) or not out.flags.c_contiguous:
+        raise ValueError("out must be a C-contiguous array of shape "
+                         "{}".format((img_num, H + 1, W + 1)))
+    out[:, 0, :] = 0
+    out[:, 1:, 0] = 0
+    body = out[:, 1:, 1:]
+    np.cumsum(images, axis=1, dtype=out.dtype, out=body)
+    np.cumsum(body, axis=2, out=body)
+    return out
+
+
+def _rect_sum(ii, rows, cols, shape):
+    """Return rectangle sums read from a padded integral image.
 
     Args:
-        images (list): List of grayscale images (uint8 or float).
+        ii (numpy.array): (H+1, W+1) integral image.
+        rows (numpy.array): Top rows of the rectangles.
+        cols (numpy.array): Left columns of the rectangles.
+        shape (tuple): (height, width) shared by the rectangles.
 
     Returns:
-        (list): List of integral images.
+        numpy.array: Rectangle sums, broadcast from rows and cols.
     """
+    h, w = shape
+    return (ii[rows + h, cols + w] - ii[rows, cols + w] -
+            ii[rows + h, cols] + ii[rows, cols])
 
-    # raise NotImplementedError
-    img_num, H, W = np.shape(images)
-    out_list = []
-    for i in range(img_num):
-    	temp_img = np.zeros((H,W))
-    	for h in range(H):
-    		for w in range(W):
-    			temp_img[h,w] = np.sum(images[i][:(h+1),:(w+1)])
-    	out_list.append(temp_img)
-    return out_list
+
+def _mean_std(sums, sq_sums, area):
+    """Return the mean and standard deviation from sums of x and x**2.
+
+    Flat windows get a standard deviation of 1 so they can be divided by.
+    """
+    mean = sums / float(area)
+    std = np.sqrt(np.maximum(sq_sums / float(area) - mean ** 2, 0.))
+    return mean, np.where(std == 0, 1., std)
 
 
+def _normalize_scores(scores, areas, sums, sq_sums, window_area):
+    """Variance normalize Haar scores in place.
+
+    A window with mean m and standard deviation s scores
+    (score - m * area) / s, see HaarFeatureBank.
+
+    Args:
+        scores (numpy.array): (..., features) scores of windows.
+        areas (numpy.array): Signed area of each feature.
+        sums (numpy.array): (...) pixel sums of the windows.
+        sq_sums (numpy.array): (...) squared pixel sums of the windows.
+        window_area (int): Number of pixels in a window.
+
+    Returns:
+        numpy.array: scores.
+    """
+    mean, std = _mean_std(sums, sq_sums, window_area)
+    scores -= np.multiply.outer(mean, areas)
+    scores /= np.expand_dims(std, -1)
+    return scores
+
+
+def _scale_rectangles(rects, scale, shape):
+    """Scale (..., 5) arrays of (row, col, height, width, sign) rectangles.
+
+    The corners are scaled and rounded, so rectangles sharing an edge
+    still share it once scaled, and clipped to a window of the given
+    shape. The sign is multiplied by the ratio between the original and
+    the scaled area to keep the rectangle's sum at the original scale.
+    """
+    r, c, h, w, s = np.moveaxis(rects, -1, 0)
+    r0, c0 = np.round(r * scale), np.round(c * scale)
+    r1 = np.minimum(np.round((r + h) * scale), shape[0])
+    c1 = np.minimum(np.round((c + w) * scale), shape[1])
+    area = (r1 - r0) * (c1 - c0)
+    sign = np.divide(s * h * w, area, out=np.zeros_like(area),
+                     where=area != 0)
+    return np.stack((r0, c0, r1 - r0, c1 - c0, sign), axis=-1)
+
+
+# Feature types used by createHaarFeatures, as (rows, cols) of rectangles
+HAAR_FEATURE_TYPES = {"two_horizontal": (2, 1),
+                      "two_vertical": (1, 2),
+                      "three_horizontal": (3, 1),
+                      "three_vertical": (1, 3),
+                      "four_square": (2, 2)}
+
+# One Haar feature: type, (row, col) position and (height, width) size
+HAAR_FEATURE_DTYPE = np.dtype([("type", np.int8, (2,)),
+                               ("position", np.int16, (2,)),
+                               ("size", np.int16, (2,))])
+
+
+def _feature_array(haarFeatures):
+    """Return features as a HAAR_FEATURE_DTYPE structured array.
+
+    Args:
+        haarFeatures: HaarFeatureSpace, structured array or list of
+                      HaarFeature objects.
+    """
+    if isinstance(haarFeatures, HaarFeatureSpace):
+        return haarFeatures.features
+    if isinstance(haarFeatures, np.ndarray):
+        return haarFeatures
+    features = np.zeros(len(haarFeatures), dtype=HAAR_FEATURE_DTYPE)
+    for fid, hf in enumerate(haarFeatures):
+        features[fid] = (hf.feat_type, hf.position, hf.size)
+    return features
+
+
+def _feature_rectangles(features):
+    """Return the rectangles of an array of features.
+
+    The rectangles follow the splits of HaarFeature._rectangles.
+
+    Args:
+        features (numpy.array): HAAR_FEATURE_DTYPE structured array.
+
+    Returns:
+        numpy.array: (features, 4, 5) array of (row, col, height, width,
+                     sign) rectangles. Features made of fewer than four
+                     rectangles are padded with empty ones.
+    """
+    r, c = features["position"].T.astype(np.intp)
+    h, w = features["size"].T.astype(np.intp)
+    ft = features["type"]
+    zero = np.zeros_like(h)
+    rects = np.zeros((len(features), 4, 5))
+
+    def put(mask, *parts):
+        for n, part in enumerate(parts):
+            rects[mask, n] = np.stack(
+                [np.broadcast_to(v, h.shape)[mask] for v in part], axis=-1)
+
+    known = np.zeros(len(features), dtype=bool)
+    for feat_type in HAAR_FEATURE_TYPES.values():
+        mask = np.all(ft == feat_type, axis=1)
+        known |= mask
+        if feat_type == (2, 1):  # two_horizontal
+            sh = h // 2
+            put(mask, (r, c, sh, w, 1), (r + sh, c, h - sh, w, -1))
+        elif feat_type == (1, 2):  # two_vertical
+            sw = w // 2
+            put(mask, (r, c, h, sw, 1), (r, c + sw, h, w - sw, -1))
+        elif feat_type == (3, 1):  # three_horizontal
+            sh = h // 3
+            put(mask, (r, c, sh, w, 1), (r + sh, c, sh, w, -1),
+                (r + 2 * sh, c, h - 2 * sh, w, 1))
+        elif feat_type == (1, 3):  # three_vertical
+            sw = w // 3
+            put(mask, (r, c, h, sw, 1), (r, c + sw, h, sw, -1),
+                (r, c + 2 * sw, h, w - 2 * sw, 1))
+        else:  # four_square
+            sh = h // 2
+            sw = w // 2
+            put(mask, (r, c, sh, sw, -1), (r, c + sw, sh, w - sw, 1),
+                (r + sh, c, h - sh, sw, 1),
+                (r + sh, c + sw, h - sh, w - sw, -1))
+    if not np.all(known):
+        raise ValueError("Unknown feature type {}".format(
+            tuple(ft[np.argmin(known)])))
+    return rects
+
+
+def _haar_corners(features, shape, scale=1.):
+    """Compile features to integral image corners.
+
+    Args:
+        features (numpy.array): HAAR_FEATURE_DTYPE structured array.
+        shape (tuple): (rows, cols) of the windows, at the given scale.
+        scale (float): Scale the features are compiled at.
+
+    Returns:
+        tuple: three-element tuple containing:
+            idx (numpy.array): (features, corners) flat indices into a
+                               (rows+1, cols+1) integral image, sorted.
+            wts (numpy.array): Matching corner weights. Coinciding corners
+                               are merged and zero weights dropped, rows
+                               are padded with index 0 and weight 0.
+            areas (numpy.array): Signed area of each feature.
+    """
+    rects = _feature_rectangles(features)
+    if scale != 1:
+        rects = _scale_rectangles(rects, scale, shape)
+    r, c, h, w, s = np.moveaxis(rects, -1, 0)
+    areas = np.sum(s * h * w, axis=1)
+
+    stride = shape[1] + 1
+    idx = np.concatenate((r * stride + c, r * stride + c + w,
+                          (r + h) * stride + c, (r + h) * stride + c + w),
+                         axis=1).astype(np.intp)
+    wts = np.concatenate((s, -s, -s, s), axis=1)
+
+    # merge equal indices: sort them, then add each run of equal indices
+    order = np.argsort(idx, axis=1, kind='stable')
+    idx = np.take_along_axis(idx, order, 1)
+    wts = np.take_along_axis(wts, order, 1)
+    run = np.ones(idx.shape, dtype=bool)
+    run[:, 1:] = idx[:, 1:] != idx[:, :-1]
+    run = np.cumsum(run, axis=1) - 1
+    rows = np.broadcast_to(np.arange(len(idx))[:, None], idx.shape)
+    merged_idx = np.zeros_like(idx)
+    merged_wts = np.zeros_like(wts)
+    merged_idx[rows, run] = idx
+    np.add.at(merged_wts, (rows, run), wts)
+
+    keep = merged_wts != 0
+    width = max(int(np.max(np.sum(keep, axis=1), initial=0)), 1)
+    slot = np.cumsum(keep, axis=1) - 1
+    idx = np.zeros((len(features), width), dtype=np.intp)
+    wts = np.zeros((len(features), width))
+    idx[rows[keep], slot[keep]] = merged_idx[keep]
+    wts[rows[keep], slot[keep]] = merged_wts[keep]
+    return idx, wts, areas
+
+
+class HaarFeatureSpace:
+    """Haar features stored as a compact structured array.
+
+    Indexing with an int returns the HaarFeature with that id, built on
+    demand (e.g. for preview), so no objects are created for the features
+    that are never looked at. Indexing with a slice or an array of ids
+    returns a HaarFeatureSpace of the selected features.
+
+    Args:
+        features (numpy.array): HAAR_FEATURE_DTYPE structured array.
+
+    Attributes:
+        features (numpy.array): HAAR_FEATURE_DTYPE structured array.
+    """
+
+    def __init__(self, features):
+        self.features = np.asarray(features, dtype=HAAR_FEATURE_DTYPE)
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, fid):
+        if isinstance(fid, (slice, np.ndarray, list)):
+            return HaarFeatureSpace(self.features[fid])
+        feature = self.features[fid]
+        return HaarFeature(tuple(feature["type"].tolist()),
+                           tuple(feature["position"].tolist()),
+                           tuple(feature["size"].tolist()))
+
+    def __iter__(self):
+        for fid in range(len(self)):
+            yield self[fid]
+
+
+def haar_feature_space(shape=(24, 24), step=4, scale_step=1, feat_types=None,
+                       dedupe=True):
+    """Enumerate the Haar features of a window.
+
+    Features of type (a, b) are a * k rows by b * l columns for every
+    k, l = 1, 1 + scale_step, ... that fits in the window, minus one in
+    each direction like the original createHaarFeatures, and are placed
+    every step pixels. With dedupe, features whose rectangles add up to
+    the same signed sum of integral image corners (for instance a four
+    square of height 1 and a two vertical feature) are kept once, and
+    features that are always 0 are dropped. The first one of each set of
+    equivalent features is kept and the order is otherwise preserved.
+
+    The number of features is the main speed / accuracy trade-off of the
+    detector: a smaller step or scale_step gives more features to choose
+    from and slower training.
+
+    Args:
+        shape (tuple): (rows, cols) of the window. Defaults to (24, 24).
+        step (int): Step between feature positions, in pixels.
+        scale_step (int): Step between feature size multiples.
+        feat_types (list): Feature types to enumerate, as (rows, cols)
+                           tuples. Defaults to HAAR_FEATURE_TYPES.
+        dedupe (bool): Whether to remove equivalent features.
+
+    Returns:
+        HaarFeatureSpace: The features.
+    """
+    if feat_types is None:
+        feat_types = list(HAAR_FEATURE_TYPES.values())
+
+    parts = []
+    for feat_type in feat_types:
+        for sizei in range(feat_type[0], shape[0] + 1,
+                           feat_type[0] * scale_step):
+            for sizej in range(feat_type[1], shape[1] + 1,
+                               feat_type[1] * scale_step):
+                posi, posj = np.meshgrid(
+                    np.arange(0, shape[0] - sizei + 1, step),
+                    np.arange(0, shape[1] - sizej + 1, step), indexing='ij')
+                part = np.zeros(posi.size, dtype=HAAR_FEATURE_DTYPE)
+                part["type"] = feat_type
+                part["position"] = np.stack((posi.ravel(), posj.ravel()), 1)
+                part["size"] = (sizei - 1, sizej - 1)
+                parts.append(part)
+    features = (np.concatenate(parts) if parts else
+                np.zeros(0, dtype=HAAR_FEATURE_DTYPE))
+
+    if dedupe and len(features):
+        idx, wts, _ = _haar_corners(features, shape)
+        # merged corners are sorted, so equal rows mean equal features
+        key = np.hstack((idx, wts.astype(np.intp)))
+        nonzero = np.flatnonzero(np.any(wts != 0, axis=1))
+        _, first = np.unique(key[nonzero], axis=0, return_index=True)
+        features = features[nonzero[np.sort(first)]]
+    return HaarFeatureSpace(features)
+
+
+class HaarFeatureBank:
+    """Haar features compiled to flat integral image corners and weights.
+
+    A rectangle sum is ii[r, c] - ii[r, c+w] - ii[r+h, c] + ii[r+h, c+w],
+    so every feature is a signed sum of a few integral image entries.
+    Coinciding corners of adjacent rectangles are merged and the features
+    are grouped by type, so each group is a fixed-width (features, corners)
+    table of flat indices and weights. Scoring a group over a stack of
+    integral images is then a single gather followed by a dot product.
+    The tables are built with array operations from the features'
+    structured array, without creating HaarFeature objects.
+
+    When squared integral images are given, scores are variance
+    normalized: a window with mean m and standard deviation s scores
+    (score - m * area) / s, where area is the signed area of the feature.
+    This is the score of the feature on (window - m) / s.
+
+    A bank can also be compiled at a scale other than 1, for windows of
+    shape * scale. The rectangles are scaled with _scale_rectangles, which
+    divides their weights by the growth of their area, so scores stay
+    comparable to the unscaled ones and the same thresholds apply.
+
+    Args:
+        haarFeatures: HaarFeatureSpace, HAAR_FEATURE_DTYPE array or list
+                      of HaarFeature objects.
+        shape (tuple): (rows, cols) of the images (windows) the features
+                       are defined on. Defaults to (24, 24).
+        scale (float): Scale the features are compiled at. Defaults to 1.
+
+    Attributes:
+        shape (tuple): Window shape the corner indices refer to.
+        num_features (int): Number of compiled features.
+        groups (list): One (feature ids, corner indices, corner weights)
+                       tuple per feature type.
+        areas (numpy.array): Signed area of each feature.
+    """
+
+    def __init__(self, haarFeatures, shape=(24, 24), scale=1.):
+        self.shape = (int(round(shape[0] * scale)),
+                      int(round(shape[1] * scale)))
+        features = _feature_array(haarFeatures)
+        self.num_features = len(features)
+        idx, wts, self.areas = _haar_corners(features, self.shape, scale)
+
+        self.groups = []
+        types = features["type"].astype(np.intp)
+        for feat_type in sorted(set(map(tuple, types.tolist()))):
+            ids = np.flatnonzero(np.all(types == feat_type, axis=1))
+            width = max(int(np.max(np.sum(wts[ids] != 0, axis=1))), 1)
+            self.groups.append((ids, idx[ids, :width], wts[ids, :width]))
+
+    def evaluate(self, ii, dtype=np.float64, chunk_size=512, out=None,
+                 sq_ii=None):
+        """Scores every feature on every integral image.
+
+        Args:
+            ii (numpy.array): (N, H+1, W+1) integral images as returned by
+                              convert_images_to_integral_images.
+            dtype (numpy.dtype): Scores type. Ignored when out is given.
+            chunk_size (int): Number of images gathered at a time, which
+                              bounds the size of the temporary arrays.
+            out (numpy.array): Optional (N, num_features) output array.
+            sq_ii (numpy.array): Optional squared integral images, the
+                                 scores are then variance normalized.
+
+        Returns:
+            numpy.array: (N, num_features) array of scores.
+        """
+        ii = np.asarray(ii)
+        img_num = len(ii)
+        if ii.shape[1:] != (self.shape[0] + 1, self.shape[1] + 1):
+            raise ValueError("Integral images of shape {} do not match the "
+                             "feature bank shape {}".format(ii.shape[1:],
+                                                            self.shape))
+        flat = ii.reshape(img_num, -1)
+        if out is None:
+            out = np.empty((img_num, self.num_features), dtype=dtype)
+
+        for start in range(0, img_num, chunk_size):
+            block = flat[start:start + chunk_size]
+            for ids, idx, wts in self.groups:
+                out[start:start + chunk_size, ids] = np.einsum(
+                    'nfk,fk->nf', block[:, idx], wts)
+
+        if sq_ii is not None:
+            _normalize_scores(out, self.areas, ii[:, -1, -1],
+                              np.asarray(sq_ii)[:, -1, -1],
+                              self.shape[0] * self.shape[1])
+        return out
+
+    def scan(self, ii, stride=1, sq_ii=None):
+        """Scores every feature at every window position of a frame.
+
+        Windows are placed every stride pixels. Each feature corner reads a
+        strided, shifted view of the frame's integral image, so windows are
+        never copied and every view covers all the positions at once.
+
+        Args:
+            ii (numpy.array): (H+1, W+1) integral image of the frame.
+            stride (int): Step between window positions, in pixels.
+            sq_ii (numpy.array): Optional squared integral image of the
+                                 frame, the scores are then variance
+                                 normalized.
+
+        Returns:
+            numpy.array: (num_features, rows, cols) array of scores, where
+                         [f, i, j] is feature f on the window whose top left
+                         corner is (i * stride, j * stride).
+        """
+        ny = max((ii.shape[0] - 1 - self.shape[0]) // stride + 1, 0)
+        nx = max((ii.shape[1] - 1 - self.shape[1]) // stride + 1, 0)
+        out = np.zeros((self.num_features, ny, nx))
+        tmp = np.empty((ny, nx))
+        for ids, idx, wts in self.groups:
+            ci, cj = np.divmod(idx, self.shape[1] + 1)
+            for n, fid in enumerate(ids):
+                for i, j, wt in zip(ci[n], cj[n], wts[n]):
+                    if wt:
+                        view = ii[i:i + stride * ny:stride,
+                                  j:j + stride * nx:stride]
+                        out[fid] += np.multiply(view, wt, out=tmp)
+
+        if sq_ii is not None:
+            rows = stride * np.arange(ny)[:, None]
+            cols = stride * np.arange(nx)
+            _normalize_scores(np.moveaxis(out, 0, -1), self.areas,
+                              _rect_sum(ii, rows, cols, self.shape),
+                              _rect_sum(sq_ii, rows, cols, self.shape),
+                              self.shape[0] * self.shape[1])
+        return out
+
+    def evaluate_at(self, ii, rows, cols, sq_ii=None, chunk_size=4096):
+        """Scores every feature on some windows of a frame.
+
+        The corners of every window are gathered straight from the frame's
+        integral image, which suits a sparse set of windows such as the
+        survivors of a cascade stage.
+
+        Args:
+            ii (numpy.array): (H+1, W+1) integral image of the frame.
+            rows (numpy.array): Top rows of the windows.
+            cols (numpy.array): Left columns of the windows.
+            sq_ii (numpy.array): Optional squared integral image of the
+                                 frame, the scores are then variance
+                                 normalized.
+            chunk_size (int): Number of windows gathered at a time.
+
+        Returns:
+            numpy.array: (windows, num_features) array of scores.
+        """
+        flat = np.ravel(ii)
+        base = np.asarray(rows) * ii.shape[1] + np.asarray(cols)
+        out = np.empty((len(base), self.num_features))
+        for ids, idx, wts in self.groups:
+            # corner offsets relative to the window's top left corner
+            ci, cj = np.divmod(idx, self.shape[1] + 1)
+            offsets = ci * ii.shape[1] + cj
+            for start in range(0, len(base), chunk_size):
+                block = base[start:start + chunk_size, None, None] + offsets
+                out[start:start + chunk_size, ids] = np.einsum(
+                    'nfk,fk->nf', flat[block], wts)
+
+        if sq_ii is not None:
+            _normalize_scores(out, self.areas,
+                              _rect_sum(ii, rows, cols, self.shape),
+                              _rect_sum(sq_ii, rows, cols, self.shape),
+                              self.shape[0] * self.shape[1])
+        return out
+
+
+def _attach_array(spec):
+    """Open an array described by HaarScoreStore.specs.
+
+    Returns:
+        tuple: The array and the object that owns its memory (the shared
+               memory block or None), which must outlive the array.
+    """
+    kind, location, shape, dtype = spec
+    if kind == "npy":
+        return np.load(location, mmap_mode='r'), None
+    shm = shared_memory.SharedMemory(name=location)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+# Arrays attached by the stump search workers, see _init_search_worker
+_search_worker = {}
+
+
+def _init_search_worker(blocks, vectors):
+    """Attach a worker process to the blocks of a HaarScoreStore."""
+    handles = []
+    attached = []
+    for start, scores_spec, order_spec, split_spec in blocks:
+        scores, shm_s = _attach_array(scores_spec)
+        order, shm_o = _attach_array(order_spec)
+        split_ok, shm_ok = _attach_array(split_spec)
+        attached.append((start, scores, order, split_ok))
+        handles += [shm_s, shm_o, shm_ok]
+    vectors, shm_v = _attach_array(vectors)
+    _search_worker.update(blocks=attached, vectors=vectors,
+                          handles=handles + [shm_v])
+
+
+def _search_block(b):
+    """Return the best stump of block b, or None if it has no split."""
+    start, scores, order, split_ok = _search_worker["blocks"][b]
+    y, weights = _search_worker["vectors"]
+    try:
+        feat, thresh, polarity, error = StumpSearch(
+            scores, y, order, split_ok).best(weights)
+    except ValueError:
+        return None
+    return (start + feat, thresh, polarity, error)
+
+
+class HaarScoreStore:
+    """Haar scores of a training set, stored by blocks of features.
+
+    The (images, features) score matrix is split into column blocks of
+    block_size features. Each block is scored with its own HaarFeatureBank
+    and kept with the row order that sorts each of its columns and the
+    StumpSearch split_ok mask of the sorted columns, which do not depend
+    on the weights, so a stump search only ever needs one block in memory
+    and does no sorting. When a directory is
+    given the blocks are .npy files opened as memory maps, otherwise they
+    are kept in RAM.
+
+    With more than one process, the blocks are searched in parallel by a
+    pool of workers. Blocks kept in RAM are then allocated in shared
+    memory, and memory-mapped blocks are opened by the workers from their
+    files, so no scores are copied between processes. The labels and
+    weights of each search are written to a shared array. The per-block
+    winners are reduced in block order, so the result is the same as a
+    search in one process.
+
+    Args:
+        haarFeatures: HaarFeatureSpace or list of HaarFeature objects.
+        ii (numpy.array): (N, H+1, W+1) integral images.
+        sq_ii (numpy.array): Optional squared integral images, the scores
+                             are then variance normalized.
+        shape (tuple): (rows, cols) of the images. Defaults to (24, 24).
+        block_size (int): Number of features in a block.
+        directory (str): Folder for memory-mapped blocks. Defaults to None
+                         (blocks kept in RAM).
+        dtype (numpy.dtype): Scores type. Defaults to float32.
+        processes (int): Number of search processes. Defaults to 1, None
+                         uses the number of CPUs.
+
+    Attributes:
+        num_images (int): Number of scored images.
+        num_features (int): Number of features.
+        blocks (list): (first feature, scores, order, split_ok) tuples,
+                       one for each block of features.
+        processes (int): Number of search processes.
+        specs (list): (first feature, scores spec, order spec, split_ok
+                      spec) tuples telling the workers where each block
+                      lives.
+    """
+
+    def __init__(self, haarFeatures, ii, sq_ii=None, shape=(24, 24),
+                 block_size=1024, directory=None, dtype=np.float32,
+                 processes=1):
+        ii = np.asarray(ii)
+        self.num_images = len(ii)
+        self.num_features = len(haarFeatures)
+        self.blocks = []
+        self.specs = []
+        num_blocks = -(-self.num_features // block_size)
+        self.processes = min(processes or os.cpu_count(), num_blocks)
+        self._shared = []
+        self._pool = None
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        idx_type = np.int32 if self.num_images < 2 ** 31 else np.intp
+        for start in range(0, self.num_features, block_size):
+            feats = haarFeatures[start:start + block_size]
+            scores, scores_spec = self._array(
+                directory, "scores", start, (self.num_images, len(feats)),
+                dtype)
+            order, order_spec = self._array(
+                directory, "order", start, (self.num_images, len(feats)),
+                idx_type)
+            HaarFeatureBank(feats, shape).evaluate(ii, out=scores,
+                                                   sq_ii=sq_ii)
+            order[:] = np.argsort(scores, axis=0, kind='stable')
+            split_ok, split_spec = self._array(
+                directory, "split", start,
+                (max(self.num_images - 1, 0), len(feats)), np.bool_)
+            np.greater(np.diff(np.take_along_axis(scores, order, 0), axis=0),
+                       0, out=split_ok)
+            if directory:
+                scores.flush()
+                order.flush()
+                split_ok.flush()
+            self.blocks.append((start, scores, order, split_ok))
+            self.specs.append((start, scores_spec, order_spec, split_spec))
+
+        if self.processes > 1:
+            self._vectors, self._vectors_spec = self._array(
+                None, "vectors", 0, (2, self.num_images), np.float64)
+
+    def _array(self, directory, name, start, shape, dtype):
+        """Return an empty block and the spec workers attach it with.
+
+        The block is memory-mapped when directory is set, in shared memory
+        when searching with several processes and a plain array otherwise.
+        """
+        dtype = np.dtype(dtype)
+        if directory:
+            path = os.path.join(directory, "{}_{:08d}.npy".format(name, start))
+            return (np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                              shape=shape),
+                    ("npy", path, shape, dtype.str))
+        if self.processes == 1:
+            return np.empty(shape, dtype=dtype), None
+        shm = shared_memory.SharedMemory(
+            create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        self._shared.append(shm)
+        return (np.ndarray(shape, dtype=dtype, buffer=shm.buf),
+                ("shm", shm.name, shape, dtype.str))
+
+    def column(self, feature):
+        """Return the scores of one feature on every image."""
+        for start, scores, _, _ in self.blocks:
+            if feature < start + scores.shape[1]:
+                return np.array(scores[:, feature - start])
+        raise IndexError("Feature {} out of range".format(feature))
+
+    def best(self, y, weights):
+        """Return the stump with the lowest weighted error.
+
+        Blocks are searched with StumpSearch, one after the other or by
+        the worker pool. Images with a zero weight do not count, so a
+        subset of the images can be searched by zeroing the weights of the
+        others.
+
+        Args:
+            y (numpy.array): Labels, one for each image (+1 or -1).
+            weights (numpy.array): Weights, one for each image.
+
+        Returns:
+            tuple: (feature, threshold, polarity, error), see
+                   StumpSearch.best. Ties are broken as in
+                   StumpSearch.best, whatever the block size.
+        """
+        if self.processes > 1:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                    self.processes, initializer=_init_search_worker,
+                    initargs=(self.specs, self._vectors_spec))
+            self._vectors[0] = y
+            self._vectors[1] = weights
+            results = self._pool.map(_search_block, range(len(self.blocks)),
+                                     chunksize=1)
+        else:
+            results = []
+            for start, scores, order, split_ok in self.blocks:
+                try:
+                    feat, thresh, polarity, error = StumpSearch(
+                        scores, y, order, split_ok).best(weights)
+                except ValueError:
+                    results.append(None)
+                    continue
+                results.append((start + feat, thresh, polarity, error))
+
+        best = None
+        for result in results:
+            if result is not None and (
+                    best is None or
+                    (result[3], -result[2]) < (best[3], -best[2])):
+                best = result
+        if best is None:
+            raise ValueError("Every feature is constant, no split exists.")
+        return best
+
+    def close(self):
+        """Stop the worker pool and free the shared memory."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self.blocks = []
+        self._vectors = None
+        for shm in self._shared:
+            shm.close()
+            shm.unlink()
+        self._shared = []
+
+
+def _grid_index(x, y, cell_x, cell_y, rows):
+    """Bucket points into a grid of cell_x by cell_y cells.
+
+    Args:
+        x, y (numpy.array): Non-negative point coordinates.
+        cell_x, cell_y (float): Size of the grid cells.
+        rows (int): Key stride between two grid columns, larger than the
+                    number of rows plus the row offsets searched.
+
+    Returns:
+        tuple: the sorted cell keys of the points and the order that sorts
+               the points by cell.
+    """
+    keys = (np.floor(x / cell_x).astype(np.int64) * rows +
+            np.floor(y / cell_y).astype(np.int64))
+    order = np.argsort(keys, kind='stable')
+    return keys[order], order
+
+
+def _grid_pairs(qx, qy, index, cell_x, cell_y, rows, spans):
+    """Return the pairs of query points and indexed points in nearby cells.
+
+    For a query point q, the cells searched are those of the grid columns
+    at offsets -len(spans) // 2 to len(spans) // 2 from q's cell, each up
+    to the row offset given by spans.
+
+    Args:
+        qx, qy (numpy.array): Query points.
+        index (tuple): Grid of the indexed points, from _grid_index.
+        cell_x, cell_y (float): Size of the grid cells.
+        rows (int): Key stride of the grid, see _grid_index.
+        spans (numpy.array): Largest row offset searched in each column,
+                             -1 to skip the column.
+
+    Returns:
+        tuple: (q, p) index arrays of the candidate pairs, grouped by q,
+               p indexing the points in the sorted order of the grid.
+    """
+    keys = index[0]
+    key = (np.floor(qx / cell_x).astype(np.int64) * rows +
+           np.floor(qy / cell_y).astype(np.int64))
+    lo, hi = [], []
+    for dx, dy in zip(range(-(len(spans) // 2), len(spans) // 2 + 1), spans):
+        if dy >= 0:
+            # the cells of a grid column have consecutive keys
+            lo.append(np.searchsorted(keys, key + dx * rows - dy, 'left'))
+            hi.append(np.searchsorted(keys, key + dx * rows + dy, 'right'))
+    counts = np.stack(hi, axis=1) - np.stack(lo, axis=1)
+    q = np.repeat(np.arange(len(key)), counts.sum(axis=1))
+    lo, counts = np.stack(lo, axis=1).ravel(), counts.ravel()
+    first = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    return q, first + np.arange(len(first))
+
+
+def group_rectangles(rects, overlap=0.3, min_neighbors=1, chunk_size=512):
+    """Merge overlapping detections into one rectangle per object.
+
+    Rectangles whose intersection over union is at least overlap are
+    linked. Only rectangles of compatible sizes can overlap that much, so
+    the links are searched for each pair of window sizes on a grid sized
+    to those windows, and each rectangle is only compared to the
+    rectangles of its neighbouring grid cells.
+
+    Groups are not the connected components of the links, which chain
+    dense detections of separate objects together. Instead, the
+    rectangle with the most links becomes the seed of a group with all
+    its ungrouped linked rectangles, and so on until every rectangle is
+    grouped. Each group is replaced by its mean rectangle.
+
+    Args:
+        rects (numpy.array): (N, 4) array of (x, y, width, height).
+        overlap (float): Intersection over union needed to link two
+                         rectangles.
+        min_neighbors (int): Groups with fewer rectangles are dropped.
+        chunk_size (int): Number of rectangles whose neighbours are
+                          compared at a time.
+
+    Returns:
+        numpy.array: (groups, 4) int array of (x, y, width, height), the
+                     largest groups first.
+    """
+    rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+    cx = rects[:, 0] + rects[:, 2] / 2.
+    cy = rects[:, 1] + rects[:, 3] / 2.
+    if len(rects):
+        cx, cy = cx - cx.min(), cy - cy.min()
+    sizes, size_ids = np.unique(rects[:, 2:], axis=0, return_inverse=True)
+    members = [np.flatnonzero(size_ids.ravel() == s)
+               for s in range(len(sizes))]
+
+    # search geometry of every pair of sizes that can overlap enough
+    grids = {}
+    for a, (wa, ha) in enumerate(sizes):
+        for b, (wb, hb) in enumerate(sizes):
+            largest = max(wa * ha, wb * hb)
+            if min(wa * ha, wb * hb) < overlap * largest:
+                continue
+            # the intersection needs overlap * largest area, which bounds
+            # how far apart the centers can be along each axis
+            reach_x = (wa + wb) / 2. - overlap * largest / min(ha, hb)
+            reach_y = (ha + hb) / 2. - overlap * largest / min(wa, wb)
+            if reach_x <= 0 or reach_y <= 0:
+                continue
+            # cells of a third of the reach, searching only the cells whose
+            # closest points can still overlap enough
+            cell_x, cell_y = reach_x / 3., reach_y / 3.
+            offsets = np.maximum(np.abs(np.arange(-4, 5)) - 1, 0)
+            ox = np.minimum((wa + wb) / 2. - offsets * cell_x, min(wa, wb))
+            oy = np.minimum((ha + hb) / 2. - offsets * cell_y, min(ha, hb))
+            # inter >= overlap * union, with the union of two fixed sizes
+            needed = overlap * (wa * ha + wb * hb) / (1. + overlap)
+            ok = ((ox[:, None] > 0) & (oy > 0) &
+                  (ox[:, None] * oy >= needed))
+            spans = (np.sum(ok, axis=1) - 1) // 2
+            rows = int(cy.max() / cell_y) + 10
+            index = _grid_index(cx[members[b]], cy[members[b]],
+                                cell_x, cell_y, rows)
+            ib = members[b][index[1]]
+            grids[a, b] = (index, ib, cx[ib], cy[ib], cell_x, cell_y, rows,
+                           spans, (wa + wb) / 2., (ha + hb) / 2.,
+                           min(wa, wb), min(ha, hb), needed)
+
+    # linked rectangles of each rectangle, as neighbours[start:stop]
+    start = np.zeros(len(rects), dtype=np.intp)
+    stop = np.zeros(len(rects), dtype=np.intp)
+    neighbours, total = [], 0
+    for a in range(len(sizes)):
+        for first in range(0, len(members[a]), chunk_size):
+            ia = members[a][first:first + chunk_size]
+            qx, qy = cx[ia], cy[ia]
+            found_q, found = [], []
+            for b in range(len(sizes)):
+                if (a, b) not in grids:
+                    continue
+                (index, ib, px, py, cell_x, cell_y, rows, spans, mid_x,
+                 mid_y, min_w, min_h, needed) = grids[a, b]
+                q, p = _grid_pairs(qx, qy, index, cell_x, cell_y, rows, spans)
+                ox = np.minimum(mid_x - np.abs(qx[q] - px[p]), min_w)
+                oy = np.minimum(mid_y - np.abs(qy[q] - py[p]), min_h)
+                keep = (ox > 0) & (oy > 0) & (ox * oy >= needed)
+                q, j = q[keep], ib[p[keep]]
+                if a == b:
+                    keep = ia[q] != j
+                    q, j = q[keep], j[keep]
+                found_q.append(q.astype(np.min_scalar_type(len(ia))))
+                found.append(j)
+            q = np.concatenate(found_q)
+            # small integer keys, sorted in linear time
+            order = np.argsort(q, kind='stable')
+            neighbours.append(np.concatenate(found)[order])
+            counts = np.bincount(q, minlength=len(ia))
+            start[ia] = total + np.cumsum(counts) - counts
+            stop[ia] = start[ia] + counts
+            total += len(q)
+    neighbours = (np.concatenate(neighbours) if neighbours else
+                  np.zeros(0, dtype=np.intp))
+
+    labels = np.full(len(rects), -1)
+    for seed in np.argsort(start - stop, kind='stable'):
+        if labels[seed] >= 0:
+            continue
+        linked = neighbours[start[seed]:stop[seed]]
+        labels[linked[labels[linked] < 0]] = seed
+        labels[seed] = seed
+
+    _, groups, counts = np.unique(labels, return_inverse=True,
+                                  return_counts=True)
+    means = np.stack([np.bincount(groups.ravel(), weights=col,
+                                  minlength=len(counts))
+                      for col in rects.T], axis=1) / counts[:, None]
+    order = np.argsort(-counts, kind='stable')
+    order = order[counts[order] >= min_neighbors]
+    return np.round(means[order]).astype(int).reshape(-1, 4)
+
 
 class ViolaJones:
     """Viola Jones face detection method
@@ -547,17 +1880,29 @@ class ViolaJones:
         pos (list): List of positive images.
         neg (list): List of negative images.
         integral_images (list): List of integral images.
+        normalize (bool): Whether Haar scores are variance normalized.
+                          Defaults to False.
 
     Attributes:
-        haarFeatures (list): List of haarFeature objects.
+        haarFeatures (HaarFeatureSpace): Haar features, see
+                                         createHaarFeatures.
         integralImages (list): List of integral images.
         classifiers (list): List of weak classifiers (VJ_Classifier).
         alphas (list): Alpha values, one for each weak classifier.
         posImages (list): List of positive images.
         negImages (list): List of negative images.
         labels (numpy.array): Positive and negative labels.
+        stages (list): Cascade stages as (first, last, threshold) tuples,
+                       stage k is made of classifiers[first:last] and
+                       accepts a window when the alpha weighted sum of their
+                       predictions is at least threshold. Empty unless
+                       trainCascade was used.
+        normalize (bool): Whether Haar scores are divided by the standard
+                          deviation of the window (after removing its
+                          mean), both in training and detection.
+        windowShape (tuple): Detector resolution (rows, cols).
     """
-    def __init__(self, pos, neg, integral_images):
+    def __init__(self, pos, neg, integral_images, normalize=False):
         self.haarFeatures = []
         self.integralImages = integral_images
         self.classifiers = []
@@ -565,35 +1910,100 @@ class ViolaJones:
         self.posImages = pos
         self.negImages = neg
         self.labels = np.hstack((np.ones(len(pos)), -1*np.ones(len(neg))))
+        self.stages = []
+        self.normalize = normalize
+        self.windowShape = (24, 24)
+
+    def createHaarFeatures(self, step=4, scale_step=1, feat_types=None,
+                           dedupe=True):
+        """Enumerate the Haar features of the detector window.
 
-    def createHaarFeatures(self):
+        See haar_feature_space. self.haarFeatures is set to a
+        HaarFeatureSpace, which builds HaarFeature objects only when a
+        feature is looked up by id.
+
+        Args:
+            step (int): Step between feature positions. Defaults to 4.
+            scale_step (int): Step between feature size multiples.
+            feat_types (list): Feature types, as (rows, cols) tuples.
+                               Defaults to HAAR_FEATURE_TYPES.
+            dedupe (bool): Whether to remove equivalent features.
+        """
         # Let's take detector resolution of 24x24 like in the paper
-        FeatureTypes = {"two_horizontal": (2, 1),
-                        "two_vertical": (1, 2),
-                        "three_horizontal": (3, 1),
-                        "three_vertical": (1, 3),
-                        "four_square": (2, 2)}
-
-        haarFeatures = []
-        for _, feat_type in FeatureTypes.items():
-            for sizei in range(feat_type[0], 24 + 1, feat_type[0]):
-                for sizej in range(feat_type[1], 24 + 1, feat_type[1]):
-                    for posi in range(0, 24 - sizei + 1, 4):
-                        for posj in range(0, 24 - sizej + 1, 4):
-                            haarFeatures.append(
-                                HaarFeature(feat_type, [posi, posj],
-                                            [sizei-1, sizej-1]))
-        self.haarFeatures = haarFeatures
-
-
-    def train(self, num_classifiers):
+        self.haarFeatures = haar_feature_space(self.windowShape, step,
+                                               scale_step, feat_types, dedupe)
+
+
+    def _score_store(self, block_size, score_dir, processes):
+        """Score every Haar feature on the training integral images.
+
+        Args:
+            block_size (int): Number of features in a block of scores.
+            score_dir (str): Folder for memory-mapped blocks, None keeps
+                             them in RAM.
+            processes (int): Number of stump search processes.
+
+        Returns:
+            HaarScoreStore: float32 scores, by blocks of features.
+        """
+        ii = np.asarray(self.integralImages)
+        sq_ii = None
+        if self.normalize:
+            images = list(self.posImages) + list(self.negImages)
+            sq_ii = convert_images_to_integral_images(
+                np.square(np.asarray(images, dtype=np.float64)))
+        return HaarScoreStore(self.haarFeatures, ii, sq_ii, self.windowShape,
+                              block_size, score_dir, processes=processes)
+
+    def _boost_round(self, store, weights):
+        """Append the stump with the lowest weighted error.
+
+        Args:
+            store (HaarScoreStore): Scores of the training images.
+            weights (numpy.array): Weights, one for each training image.
+                                   Images with a zero weight are ignored.
+
+        Returns:
+            tuple: two-element tuple containing:
+                weights (numpy.array): Updated (unnormalized) weights.
+                predictions (numpy.array): The stump's predictions (1, -1),
+                                           one for each training image.
+        """
+        weights = weights / np.sum(weights)
+        feat, thresh, polarity, error = store.best(self.labels, weights)
+        # The stump is already trained, so it is not handed the scores.
+        vjc = VJ_Classifier(np.zeros((0, store.num_features)),
+                            self.labels[:0], weights[:0],
+                            thresh=thresh, feat=feat, polarity=polarity)
+        vjc.error = error
+        self.classifiers.append(vjc)
+
+        # a perfect stump would make beta zero
+        beta = max(error, 1e-10) / (1. - error)
+        predictions = polarity * np.where(store.column(feat) < thresh, 1, -1)
+        weights = np.where(predictions == self.labels, weights * beta,
+                           weights)
+        self.alphas.append(math.log((1.)/beta))
+        return weights, predictions
+
+    def train(self, num_classifiers, block_size=1024, score_dir=None,
+              processes=1):
+        """Train a boosted classifier of num_classifiers weak classifiers.
+
+        Args:
+            num_classifiers (int): Number of weak classifiers.
+            block_size (int): Number of features scored and searched at a
+                              time, which bounds the memory used.
+            score_dir (str): Folder where the float32 scores are kept as
+                             memory-mapped files. Defaults to None (RAM).
+            processes (int): Number of processes searching the feature
+                             blocks. Defaults to 1, None uses every CPU.
+        """
 
         # Use this scores array to train a weak classifier using VJ_Classifier
         # in the for loop below.
-        scores = np.zeros((len(self.integralImages), len(self.haarFeatures)))
         print(" -- compute all scores --")
-        for i, im in enumerate(self.integralImages):
-            scores[i, :] = [hf.evaluate(im) for hf in self.haarFeatures]
+        store = self._score_store(block_size, score_dir, processes)
 
         weights_pos = np.ones(len(self.posImages), dtype='float') * 1.0 / (
                            2*len(self.posImages))
@@ -602,27 +2012,154 @@ class ViolaJones:
         weights = np.hstack((weights_pos, weights_neg))
 
         print(" -- select classifiers --")
-        
-        for i in range(num_classifiers):
+        try:
+            for i in range(num_classifiers):
+                weights, _ = self._boost_round(store, weights)
+        finally:
+            store.close()
+
+    def trainCascade(self, fp_rate=0.5, det_rate=0.99, target_fp_rate=1e-3,
+                     max_stages=10, max_stage_classifiers=50, block_size=1024,
+                     score_dir=None, processes=1):
+        """Train an attentional cascade of boosted stages.
+
+        Stages are trained one after the other. Each stage adds weak
+        classifiers until it rejects enough of the negatives that passed
+        the previous stages, with its threshold lowered so that it still
+        accepts det_rate of the positives. Training stops once the overall
+        false positive rate reaches target_fp_rate or every negative has
+        been rejected. The negatives rejected by earlier stages get a zero
+        weight, so the scores are computed once for every stage.
+
+        The weak classifiers of all stages are appended to self.classifiers
+        and self.alphas, and the stages are recorded in self.stages.
 
-            # TODO: Complete the Viola Jones algorithm
+        Args:
+            fp_rate (float): Maximum false positive rate of each stage.
+            det_rate (float): Minimum detection rate of each stage.
+            target_fp_rate (float): Overall false positive rate to reach.
+            max_stages (int): Maximum number of stages.
+            max_stage_classifiers (int): Maximum number of weak classifiers
+                                         in a stage.
+            block_size (int): Number of features scored and searched at a
+                              time, which bounds the memory used.
+            score_dir (str): Folder where the float32 scores are kept as
+                             memory-mapped files. Defaults to None (RAM).
+            processes (int): Number of processes searching the feature
+                             blocks. Defaults to 1, None uses every CPU.
+        """
+        if not 0. < det_rate <= 1.:
+            raise ValueError("det_rate must be in (0, 1], got {}".format(
+                det_rate))
+        print(" -- compute all scores --")
+        store = self._score_store(block_size, score_dir, processes)
+        try:
+            self._train_stages(store, fp_rate, det_rate, target_fp_rate,
+                               max_stages, max_stage_classifiers)
+        finally:
+            store.close()
+
+    def _train_stages(self, store, fp_rate, det_rate, target_fp_rate,
+                      max_stages, max_stage_classifiers):
+        """Run the stage loop of trainCascade on a score store."""
+        is_pos = self.labels == 1
+        alive = ~is_pos
+        overall_fp = 1.
+
+        print(" -- train stages --")
+        while (overall_fp > target_fp_rate and np.any(alive) and
+               len(self.stages) < max_stages):
+            weights = np.where(is_pos, 0.5 / np.sum(is_pos),
+                               np.where(alive, 0.5 / np.sum(alive), 0.))
+
+            start = len(self.classifiers)
+            total = np.zeros(len(self.labels))
+            for _ in range(max_stage_classifiers):
+                weights, predictions = self._boost_round(store, weights)
+                total += self.alphas[-1] * predictions
+
+                # Lower the threshold until det_rate of the positives pass
+                pos_total = np.sort(total[is_pos])
+                k = min(int((1. - det_rate) * len(pos_total)),
+                        len(pos_total) - 1)
+                threshold = min(0.5 * np.sum(self.alphas[start:]),
+                                pos_total[k])
+                passed = total[alive] >= threshold
+                if np.mean(passed) <= fp_rate:
+                    break
+
+            self.stages.append((start, len(self.classifiers), float(threshold)))
+            overall_fp *= np.mean(passed)
+            alive[alive] = passed
+            print(" stage {}: {} classifiers, false positive rate {:.4f}".format(
+                len(self.stages), len(self.classifiers) - start, overall_fp))
+
+    def _compiled_stages(self, scale=1.):
+        """Return the stages compiled for batched evaluation.
+
+        Without a cascade the whole strong classifier is a single stage
+        with the 0.5 * sum(alphas) threshold.
 
-            sum_temp = np.sum(weights)
-            weights = weights / sum_temp
-            vjc = VJ_Classifier(scores, self.labels, weights, thresh=0, feat=0, polarity=1)
-            vjc.train()
-            error = vjc.error
-            self.classifiers.append(vjc)
+        Args:
+            scale (float): Scale the Haar features are compiled at.
 
-            beta = float(error) / (1. - error)
-            for j in range(len(self.integralImages)):
-            	if self.labels[j] == vjc.predict(scores[j]): weights[j] = weights[j] * beta
-            	else: weights[j] = weights[j] 
-            weights = np.asarray(weights)
-            self.alphas.append(math.log((1.)/beta))
-	        
+        Returns:
+            list: (HaarFeatureBank, thresholds, polarities, alphas,
+                  stage threshold) tuples, one for each stage.
+        """
+        stages = self.stages or [
+            (0, len(self.classifiers), 0.5 * np.sum(self.alphas))]
+        compiled = []
+        for start, stop, threshold in stages:
+            clfs = self.classifiers[start:stop]
+            bank = HaarFeatureBank(
+                [self.haarFeatures[clf.feature] for clf in clfs],
+                self.windowShape, scale)
+            compiled.append((bank,
+                             np.array([clf.threshold for clf in clfs]),
+                             np.array([clf.polarity for clf in clfs]),
+                             np.array(self.alphas[start:stop]),
+                             threshold))
+        return compiled
+
+    @staticmethod
+    def _stage_pass(stage, scores):
+        """Return which windows a compiled stage accepts.
 
-            # raise NotImplementedError
+        Args:
+            stage (tuple): Compiled stage.
+            scores (numpy.array): (..., features) scores of the stage's
+                                  features.
+
+        Returns:
+            numpy.array: Boolean array of accepted windows.
+        """
+        _, thresh, polarity, alphas, threshold = stage
+        h = polarity * np.where(scores < thresh, 1, -1)
+        return np.dot(h, alphas) >= threshold
+
+    def _cascade(self, ii, sq_ii=None):
+        """Run the stages on integral images.
+
+        Each stage only scores the images accepted by the previous stages,
+        so most windows are rejected after the first few features.
+
+        Args:
+            ii (numpy.array): (N, H+1, W+1) integral images.
+            sq_ii (numpy.array): Squared integral images, used when the
+                                 detector is variance normalized.
+
+        Returns:
+            numpy.array: Ids of the images accepted by every stage.
+        """
+        alive = np.arange(len(ii))
+        for stage in self._compiled_stages():
+            if not len(alive):
+                break
+            scores = stage[0].evaluate(
+                ii[alive], sq_ii=None if sq_ii is None else sq_ii[alive])
+            alive = alive[self._stage_pass(stage, scores)]
+        return alive
 
     def predict(self, images):
         """Return predictions for a given list of images.
@@ -635,44 +2172,118 @@ class ViolaJones:
         """
 
         ii = convert_images_to_integral_images(images)
+        sq_ii = None
+        if self.normalize:
+            sq_ii = convert_images_to_integral_images(
+                np.square(np.asarray(images, dtype=np.float64)))
 
-        scores = np.zeros((len(ii), len(self.haarFeatures)))
+        result = -np.ones(len(ii), dtype=int)
+        result[self._cascade(ii, sq_ii)] = 1
+        return list(result)
 
-        for i, x in enumerate(ii):
-        # Populate the score location for each classifier 'clf' in
-        # self.classifiers.
-        	for clf in self.classifiers:
-        # Obtain the Haar feature id from clf.feature
-        		ind = clf.feature
+    def _frame_integrals(self, image):
+        """Return the integral images used to scan a grayscale frame.
 
-        # Use this id to select the respective feature object from
-        # self.haarFeatures
-        		feature = self.haarFeatures[ind]
+        Returns:
+            tuple: (H+1, W+1) integral image and squared integral image
+                   (None unless the detector is variance normalized).
+        """
+        ii = convert_images_to_integral_images(image[None])[0]
+        sq_ii = None
+        if self.normalize:
+            sq_ii = convert_images_to_integral_images(
+                np.square(image, dtype=np.float64)[None])[0]
+        return ii, sq_ii
+
+    def _scan(self, ii, sq_ii, stride, scale):
+        """Return the top left corners of the windows every stage accepts.
+
+        The first stage scores every window position at once through
+        shifted views of the frame's integral image, the later stages only
+        gather the corners of the windows still alive.
+        """
+        stages = self._compiled_stages(scale)
+        first = stages[0]
+        scores = np.moveaxis(first[0].scan(ii, stride, sq_ii), 0, -1)
+        rows, cols = np.nonzero(self._stage_pass(first, scores))
+        rows, cols = rows * stride, cols * stride
+
+        for stage in stages[1:]:
+            if not len(rows):
+                break
+            keep = self._stage_pass(
+                stage, stage[0].evaluate_at(ii, rows, cols, sq_ii))
+            rows, cols = rows[keep], cols[keep]
+        return rows, cols
+
+    def scanWindows(self, image, stride=1, scale=1.):
+        """Return the windows of a grayscale image classified as faces.
+
+        One integral image (and squared integral image when normalizing)
+        of the whole frame is computed and every window is scored from it,
+        without copying any window.
 
-        # Add the score value to score[x, feature id] calling the feature's
-        # evaluate function. 'x' is each image in 'ii'
-        		scores[i, ind] = feature.evaluate(x)
+        Args:
+            image (numpy.array): Grayscale image.
+            stride (int): Step between window positions, in pixels.
+            scale (float): Window size as a multiple of windowShape.
 
-        result = []
+        Returns:
+            tuple: two-element tuple containing:
+                rows (numpy.array): Top rows of the accepted windows.
+                cols (numpy.array): Left columns of the accepted windows.
+        """
+        ii, sq_ii = self._frame_integrals(image)
+        return self._scan(ii, sq_ii, stride, scale)
 
-        # Append the results for each row in 'scores'. This value is obtained
-        # using the equation for the strong classifier H(x).
+    def detectMultiScale(self, image, scale_factor=1.25, stride=1,
+                         min_size=None, max_size=None, overlap=0.3,
+                         min_neighbors=1):
+        """Return the faces found in a grayscale image at every scale.
 
-        for x in scores:
-            # TODO
-            temp_sum = 0.
-            for j in range(len(self.classifiers)):
-            	temp_sum += self.alphas[j] * self.classifiers[j].predict(x)
-            temp_alpha = 0.5 * np.sum(self.alphas)
-            res = -1
-            if temp_sum >= temp_alpha: 
-            	res = 1
-            result.append(res)
-            # raise NotImplementedError
+        The frame's integral images are computed once. Larger faces are
+        found by scaling the Haar features, not by resizing the image: the
+        window grows geometrically by scale_factor from windowShape until
+        it no longer fits in the image, and windows are placed every
+        stride * scale pixels. Overlapping detections are then merged with
+        group_rectangles.
 
-        return result
+        Args:
+            image (numpy.array): Grayscale image.
+            scale_factor (float): Ratio between two consecutive scales.
+            stride (int): Step between window positions at scale 1.
+            min_size (tuple): Smallest (rows, cols) window to scan.
+            max_size (tuple): Largest (rows, cols) window to scan.
+            overlap (float): Intersection over union above which two
+                             detections belong to the same face.
+            min_neighbors (int): Detections needed to report a face.
 
-    def faceDetection(self, image, filename):
+        Returns:
+            numpy.array: (faces, 4) array of (x, y, width, height).
+        """
+        ii, sq_ii = self._frame_integrals(image)
+        min_size = min_size or self.windowShape
+        rects = []
+        scale = 1.
+        while True:
+            size = (int(round(self.windowShape[0] * scale)),
+                    int(round(self.windowShape[1] * scale)))
+            if (size[0] > image.shape[0] or size[1] > image.shape[1] or
+                    (max_size and (size[0] > max_size[0] or
+                                   size[1] > max_size[1]))):
+                break
+            if size[0] >= min_size[0] and size[1] >= min_size[1]:
+                step = max(1, int(round(stride * scale)))
+                rows, cols = self._scan(ii, sq_ii, step, scale)
+                rects.append(np.stack((cols, rows,
+                                       np.full(len(rows), size[1]),
+                                       np.full(len(rows), size[0])), axis=1))
+            scale *= scale_factor
+
+        rects = np.vstack(rects) if rects else np.zeros((0, 4), dtype=int)
+        return group_rectangles(rects, overlap, min_neighbors)
+
+    def faceDetection(self, image, filename, stride=1, scale_factor=1.25):
         """Scans for faces in a given image.
 
         Complete this function following the instructions in the problem set
@@ -683,6 +2294,8 @@ class ViolaJones:
         Args:
             image (numpy.array): Input image.
             filename (str): Output image file name.
+            stride (int): Step between window positions, in pixels.
+            scale_factor (float): Ratio between two consecutive scales.
 
         Returns:
             None.
@@ -692,40 +2305,71 @@ class ViolaJones:
         img_temp = np.copy(image)
         img_gray = cv2.cvtColor(img_temp,cv2.COLOR_BGR2GRAY)
 
-        w,b = np.shape(img_gray)
-        r = 24
-        c = 24
-        ul = []
-        lr = []
-        windows = []
-        for i in range(w-r):
-        	for j in range(b-c):
-        		window = np.zeros((c,r))
-        		ul.append([j,i])
-        		lr.append([j+c,i+r])
-        		window[:,:] = img_gray[i:(i+r),j:(j+c)]
-        		windows.append(window)
-        # windows = np.asarray(windows)
-        # print(np.shape(windows))
-        
-        # print(np.shape(windows))
-        predictions = self.predict(windows)
-
-        pos_ul,pos_lr = [],[]
-        for i, pred in enumerate(predictions):
-        	if pred == 1:
-        		pos_ul.append(ul[i])
-        		pos_lr.append(lr[i])
-
-        pos_ul = np.asarray(pos_ul)
-        pos_lr = np.asarray(pos_lr)
-
-        ave_ul = np.mean(pos_ul, axis=0).astype(int) + (3,-3)
-        ave_lr = np.mean(pos_lr, axis=0).astype(int) + (3,-3)
-
-        cv2.rectangle(img_temp, tuple(ave_ul), tuple(ave_lr), (0,0,255), 2)
+        faces = self.detectMultiScale(img_gray, scale_factor, stride)
+        for (x, y, w, h) in faces:
+            cv2.rectangle(img_temp, (int(x), int(y)), (int(x + w), int(y + h)),
+                          (0,0,255), 2)
         cv2.imwrite("output/{}.png".format(filename), img_temp)
 
+    def save(self, filename):
+        """Save the trained detector to an .npz file.
+
+        Only the Haar features the weak classifiers use are stored, with
+        the classifiers' thresholds, polarities and alphas and the cascade
+        stages. Training images and scores are not saved. The file is
+        written under filename as given, without adding .npz to it.
 
+        Args:
+            filename (str): Output file name.
+        """
+        used, feats = np.unique([clf.feature for clf in self.classifiers],
+                                return_inverse=True)
+        used = _feature_array([self.haarFeatures[i] for i in used])
+        with open(filename, "wb") as f:
+            np.savez(f, version=MODEL_VERSION,
+                     feat_types=used["type"].astype(int),
+                     positions=used["position"].astype(int),
+                     sizes=used["size"].astype(int),
+                     features=np.asarray(feats, dtype=int).reshape(-1),
+                     thresholds=np.array([clf.threshold for clf in
+                                          self.classifiers], dtype=float),
+                     polarities=np.array([clf.polarity for clf in
+                                          self.classifiers], dtype=int),
+                     alphas=np.array(self.alphas, dtype=float),
+                     stages=np.array(self.stages, dtype=float).reshape(-1, 3),
+                     normalize=self.normalize, window_shape=self.windowShape)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a detector saved with ViolaJones.save.
+
+        The returned detector has no training images and only the Haar
+        features its classifiers use, which is all predict and
+        faceDetection need.
 
+        Args:
+            filename (str): Model file name.
 
+        Returns:
+            ViolaJones: Trained detector.
+        """
+        with np.load(filename, allow_pickle=False) as model:
+            _check_model_version(model, filename)
+            vj = cls([], [], [], normalize=bool(model["normalize"]))
+            vj.windowShape = tuple(model["window_shape"].tolist())
+            features = np.zeros(len(model["feat_types"]),
+                                dtype=HAAR_FEATURE_DTYPE)
+            features["type"] = model["feat_types"]
+            features["position"] = model["positions"]
+            features["size"] = model["sizes"]
+            vj.haarFeatures = HaarFeatureSpace(features)
+            for feat, thresh, polarity in zip(model["features"].tolist(),
+                                              model["thresholds"].tolist(),
+                                              model["polarities"].tolist()):
+                vj.classifiers.append(VJ_Classifier(
+                    np.zeros((0, len(vj.haarFeatures))), vj.labels,
+                    vj.labels, thresh=thresh, feat=feat, polarity=polarity))
+            vj.alphas = model["alphas"].tolist()
+            vj.stages = [(int(start), int(stop), threshold) for
+                         start, stop, threshold in model["stages"].tolist()]
+        return vj
@@ -126,6 +126,68 @@ def run_particle_filter_5(filter_class, imgs_dir, template_rect1,template_rect2,
         if frame_num % 20 == 0:
             print('Working on frame {}'.format(frame_num))
 
+def run_multi_target_filter(imgs_dir, targets, save_frames={}, **kwargs):
+    """Runs a MultiTargetPF on a given video.
+
+    Every target is tracked from its first frame, where its template is
+    extracted, to its last frame. All targets share one MultiTargetPF, so
+    each frame is converted and processed once.
+
+    Args:
+        imgs_dir (str): path to input images.
+        targets (list): (template_rect, first frame, last frame) tuples,
+                        template_rect being a dict of template bounds
+                        (x, y, w, h) and last frame None for the end of
+                        the video.
+        save_frames (dict): frames to save {<frame number>: <filename>}.
+        **kwargs: arbitrary keyword arguments passed on to MultiTargetPF.
+
+    Returns:
+        None.
+    """
+
+    imgs_list = [f for f in os.listdir(imgs_dir)
+                 if f[0] != '.' and f.endswith('.jpg')]
+    imgs_list.sort()
+
+    mt = None
+    ids = {}
+    frame_num = 0
+
+    for img in imgs_list:
+
+        frame = cv2.imread(os.path.join(imgs_dir, img))
+        if mt is None:
+            mt = ps5.MultiTargetPF(frame, **kwargs)
+
+        for k, (rect, first, last) in enumerate(targets):
+            if frame_num == first:
+                template = frame[int(rect['y']):int(rect['y'] + rect['h']),
+                                 int(rect['x']):int(rect['x'] + rect['w'])]
+                ids[k] = mt.add_target(template)
+            if last is not None and frame_num == last + 1 and k in ids:
+                mt.remove_target(ids.pop(k))
+
+        # Process frame
+        mt.process(frame)
+
+        if True:  # For debugging, it displays every frame
+            out_frame = frame.copy()
+            mt.render(out_frame)
+            cv2.imshow('Tracking', out_frame)
+            cv2.waitKey(1)
+
+        # Render and save output, if indicated
+        if frame_num in save_frames:
+            frame_out = frame.copy()
+            mt.render(frame_out)
+            cv2.imwrite(save_frames[frame_num], frame_out)
+
+        # Update frame number
+        frame_num += 1
+        if frame_num % 20 == 0:
+            print('Working on frame {}'.format(frame_num))
+
 def run_particle_filter_6(filter_class, imgs_dir, template_rect,
                         save_frames={}, **kwargs):
     """Runs a particle filter on a given video and template.
@@ -600,14 +662,16 @@ def part_5():
     sigma_dyn = 15  # Define the value of sigma for the particles movement (dynamics)
     alpha = 0.02  # Set a value for alpha
 
-    run_particle_filter_5(ps5.AppearanceModelPF,  # particle filter model class
-                        os.path.join(input_dir, "TUD-Campus"),
-                        # input video
-                        template_rect1,template_rect2,template_rect3,
-                        save_frames,
-                        num_particles=num_particles, sigma_exp=sigma_mse,
-                        sigma_dyn=sigma_dyn, alpha=alpha,
-                        template_coords=template_rect1)  # Add more if you need to
+    # Same targets and frame ranges as run_particle_filter_5, in one batch
+    targets = [(template_rect1, 0, 61),
+               (template_rect2, 0, 47),
+               (template_rect3, 25, None)]
+
+    run_multi_target_filter(os.path.join(input_dir, "TUD-Campus"),
+                            targets,
+                            save_frames,
+                            num_particles=num_particles, sigma_exp=sigma_mse,
+                            sigma_dyn=sigma_dyn, alpha=alpha)
     
     # # KF -------------------------------------------------------------------------------#
     # template_rect1 = {'x': 80, 'y': 150, 'w': 80, 'h': 150}
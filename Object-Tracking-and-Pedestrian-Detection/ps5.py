@@ -54,6 +54,257 @@ class KalmanFilter(object):
         return self.state[0,0], self.state[0,1]
 
 
+class KalmanFilterBank(object):
+    """Kalman filters of N constant velocity targets, run as one batch.
+
+    The states of all targets are stacked in one (N, 4) array of
+    (x, y, vx, vy) and their covariances in one (N, 4, 4) array, so that
+    predict and correct are a few stacked matrix products over the whole
+    bank, with no np.matrix and no Python loop. The measurement matrix only
+    selects the position, so its products are slices of the covariances,
+    and the 2x2 innovation covariances are inverted in closed form.
+
+    Args:
+        init_x (numpy.array): Initial x position of each target.
+        init_y (numpy.array): Initial y position of each target.
+        Q (numpy.array): (4, 4) process noise array, shared by all
+                         targets, or (N, 4, 4) array, one for each target.
+        R (numpy.array): (2, 2) measurement noise array, or (N, 2, 2).
+
+    Attributes:
+        state (numpy.array): (N, 4) states (x, y, vx, vy).
+        P (numpy.array): (N, 4, 4) state covariances.
+    """
+
+    def __init__(self, init_x, init_y, Q=0.1 * np.eye(4), R=0.1 * np.eye(2)):
+        init_x = np.asarray(init_x, dtype=np.float64).ravel()
+        init_y = np.asarray(init_y, dtype=np.float64).ravel()
+        if init_x.shape != init_y.shape:
+            raise ValueError("init_x and init_y must have the same length")
+        self.Q = np.asarray(Q, dtype=np.float64)
+        self.R = np.asarray(R, dtype=np.float64)
+        self.D = np.array([[1., 0., 1., 0.],
+                           [0., 1., 0., 1.],
+                           [0., 0., 1., 0.],
+                           [0., 0., 0., 1.]])
+        self.state = np.zeros((len(init_x), 4))
+        self.state[:, 0] = init_x
+        self.state[:, 1] = init_y
+        self.P = np.zeros((len(init_x), 4, 4))
+
+    def __len__(self):
+        return len(self.state)
+
+    def predict(self):
+        """Moves every state one time step forward."""
+        self.state = self.state @ self.D.T
+        self.P = self.D @ self.P @ self.D.T + self.Q
+
+    def correct(self, meas_x, meas_y):
+        """Corrects every state with its measured position.
+
+        Args:
+            meas_x (numpy.array): Measured x position of each target.
+            meas_y (numpy.array): Measured y position of each target.
+        """
+        # P M^T and M P M^T, M selecting the position
+        PMt = self.P[:, :, :2]
+        S = self.P[:, :2, :2] + self.R
+        det = S[:, 0, 0] * S[:, 1, 1] - S[:, 0, 1] * S[:, 1, 0]
+        S_inv = np.empty_like(S)
+        S_inv[:, 0, 0] = S[:, 1, 1]
+        S_inv[:, 0, 1] = -S[:, 0, 1]
+        S_inv[:, 1, 0] = -S[:, 1, 0]
+        S_inv[:, 1, 1] = S[:, 0, 0]
+        S_inv /= det[:, None, None]
+        K = PMt @ S_inv
+
+        Y = np.stack([meas_x, meas_y], axis=-1).astype(np.float64)
+        innovation = Y - self.state[:, :2]
+        self.state = self.state + np.einsum('nij,nj->ni', K, innovation)
+        self.P = self.P - K @ self.P[:, :2, :]
+
+    def process(self, measurement_x, measurement_y):
+        """Predicts and corrects every target with its new measurement.
+
+        Args:
+            measurement_x (numpy.array): Measured x position of each target.
+            measurement_y (numpy.array): Measured y position of each target.
+
+        Returns:
+            tuple: (x, y) arrays of the corrected positions.
+        """
+        self.predict()
+        self.correct(measurement_x, measurement_y)
+        return self.state[:, 0], self.state[:, 1]
+
+
+RESAMPLERS = ('multinomial', 'systematic', 'stratified', 'residual')
+
+
+def resample_indices(weights, n, scheme='systematic'):
+    """Draws n particle indices with probabilities given by weights.
+
+    Every scheme inverts the cumulative sum of the weights with
+    np.searchsorted, so drawing n indices is O(n log N) with no Python loop:
+
+    - multinomial: n independent uniform draws.
+    - stratified: one uniform draw in each of the n strata [i/n, (i+1)/n).
+    - systematic: a single uniform offset shared by the n strata.
+    - residual: floor(n * w) copies of each particle, and the remaining
+      draws are multinomial on the leftover weights.
+
+    Args:
+        weights (numpy.array): Normalized weights, one for each particle,
+                               or a (T, N) array of T independent sets of
+                               weights, which are resampled together.
+        n (int): Number of indices to draw.
+        scheme (str): One of RESAMPLERS.
+
+    Returns:
+        numpy.array: n particle indices, (T, n) for a (T, N) weights array.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.ndim == 1:
+        return resample_indices(weights[None], n, scheme)[0]
+    sets, count = weights.shape
+
+    if scheme == 'residual':
+        counts = np.floor(n * weights).astype(int)
+        out = np.empty((sets, n), dtype=int)
+        for t in range(sets):
+            kept = np.repeat(np.arange(count), counts[t])
+            out[t, :len(kept)] = kept
+            if len(kept) < n:
+                residual = n * weights[t] - counts[t]
+                out[t, len(kept):] = resample_indices(
+                    residual / np.sum(residual), n - len(kept), 'multinomial')
+        return out
+
+    if scheme == 'multinomial':
+        positions = np.random.random((sets, n))
+    elif scheme == 'stratified':
+        positions = (np.arange(n) + np.random.random((sets, n))) / n
+    elif scheme == 'systematic':
+        positions = (np.arange(n) + np.random.random((sets, 1))) / n
+    else:
+        raise ValueError("Unknown resampler '{}'".format(scheme))
+    cumulative = np.cumsum(weights, axis=1)
+    cumulative /= cumulative[:, -1:]
+    # shift set t by t so that a single searchsorted covers every set
+    offsets = np.arange(sets)[:, None]
+    idx = np.searchsorted((cumulative + offsets).ravel(),
+                          (positions + offsets).ravel(), side='right')
+    idx = idx.reshape(sets, n) - offsets * count
+    return np.clip(idx, 0, count - 1)
+
+
+def kld_bound(k, epsilon=0.05, z=2.326):
+    """Returns the KLD-sampling bound on the number of particles.
+
+    With k occupied bins, drawing this many particles keeps the KL
+    divergence between the particle approximation and the true posterior
+    below epsilon with probability 1 - delta (Wilson-Hilferty
+    approximation of the chi-square quantile).
+
+    Args:
+        k (numpy.array): Numbers of occupied bins.
+        epsilon (float): Bound on the KL divergence.
+        z (float): Upper 1 - delta quantile of the standard normal
+                   distribution, 2.326 for delta = 0.01.
+
+    Returns:
+        numpy.array: Number of particles for each k, 0 when k <= 1.
+    """
+    k = np.asarray(k, dtype=np.float64)
+    a = 2. / (9. * np.maximum(k - 1., 1.))
+    bound = (k - 1.) / (2. * epsilon) * (1. - a + np.sqrt(a) * z) ** 3
+    return np.where(k > 1, np.ceil(bound), 0.)
+
+
+def _ssd_mse(img, template, minx, miny):
+    """Returns the MSE between a template and the patches at minx, miny.
+
+    The sum of squared differences is computed once for every position of
+    the bounding box of the patches (cv2.matchTemplate, TM_SQDIFF) and each
+    patch reads its value from that map.
+    """
+    mh, mw = np.shape(template)
+    x0, y0 = minx.min(), miny.min()
+    box = img[y0:miny.max() + mh, x0:minx.max() + mw]
+    ssd = cv2.matchTemplate(np.asarray(box, dtype=np.float32),
+                            np.asarray(template, dtype=np.float32),
+                            cv2.TM_SQDIFF)
+    return ssd[miny - y0, minx - x0].astype(np.float64) / (mh * mw)
+
+
+def render_particles(frame_in, particles, weights, template_shape,
+                     radius=2):
+    """Draws a particle cloud, its weighted mean window and its spread.
+
+    The particle dots are the pixels of a filled disk around each particle,
+    the same pixels cv2.circle fills, and are all set with one array write.
+
+    Args:
+        frame_in (numpy.array): BGR frame to draw on.
+        particles (numpy.array): (N, 2) particles (x, y).
+        weights (numpy.array): Normalized weights, one for each particle.
+        template_shape (tuple): (rows, cols) of the tracking window.
+        radius (int): Radius of the particle dots.
+
+    Returns:
+        numpy.array: frame_in.
+    """
+    m, n = template_shape
+    h, w = frame_in.shape[:2]
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    disk = dx ** 2 + dy ** 2 <= radius ** 2
+    xy = particles.astype(int)
+    x = (xy[:, 0, None] + dx[disk]).ravel()
+    y = (xy[:, 1, None] + dy[disk]).ravel()
+    inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+    frame_in[y[inside], x[inside]] = (200, 0, 0)
+
+    x_weighted_mean, y_weighted_mean = np.dot(weights, particles)
+    cv2.rectangle(frame_in, (int(x_weighted_mean) - n // 2, int(y_weighted_mean) - m // 2),
+                     (int(x_weighted_mean) + n // 2, int(y_weighted_mean) + m // 2), (0, 200, 0), 2)
+
+    dis = np.hypot(particles[:, 0] - x_weighted_mean,
+                   particles[:, 1] - y_weighted_mean)
+    dis_weighted_mean = np.dot(weights, dis)
+    cv2.circle(frame_in, (int(x_weighted_mean), int(y_weighted_mean)), int(dis_weighted_mean), (200, 200, 200), 2)
+    return frame_in
+
+
+# Last frame converted by gray_scale and its grayscale image
+_gray_cache = {'frame': None, 'gray': None}
+
+
+def gray_scale(frame):
+    """Returns the grayscale image of a BGR frame.
+
+    The channels are weighted 0.3, 0.58 and 0.12 in float32, in a single
+    matrix product. The result of the last frame is cached by identity, so
+    the filters, their model updates and every other tracker working on the
+    same frame object share one conversion. Frames must not be modified
+    in place once converted; the returned image is read-only.
+
+    Args:
+        frame (numpy.array): color BGR uint8 image.
+
+    Returns:
+        numpy.array: float32 grayscale image.
+    """
+    if _gray_cache['frame'] is frame:
+        return _gray_cache['gray']
+    gray = (np.asarray(frame, dtype=np.float32) @
+            np.array([0.3, 0.58, 0.12], dtype=np.float32))
+    gray.flags.writeable = False
+    _gray_cache['frame'] = frame
+    _gray_cache['gray'] = gray
+    return gray
+
+
 class ParticleFilter(object):
     """A particle filter tracker.
 
@@ -95,6 +346,36 @@ class ParticleFilter(object):
                                          adding gaussian noise to u and v.
                     - template_rect (dict): Template coordinates with x, y,
                                             width, and height values.
+                    - observation (str): 'patches' (default) compares each
+                                         particle's patch with the template,
+                                         'ssd_map' computes the SSD map of
+                                         the particle cloud's bounding box
+                                         once and looks the particles up in
+                                         it.
+                    - resampler (str): Resampling scheme, one of RESAMPLERS.
+                                       Defaults to 'systematic'.
+                    - ess_threshold (float): Resample when the effective
+                                             sample size is below this
+                                             fraction of the particles.
+                                             Defaults to 0.5, 1 resamples
+                                             every frame.
+                    - adaptive (bool): Pick the number of particles with
+                                       KLD-sampling when resampling,
+                                       see kld_resample_indices.
+                                       Defaults to False.
+                    - min_particles (int): Fewest particles in adaptive
+                                           mode. Defaults to 100, or
+                                           num_particles if lower.
+                    - max_particles (int): Most particles in adaptive
+                                           mode. Defaults to
+                                           num_particles.
+                    - kld_epsilon (float): KL divergence bound. Defaults
+                                           to 0.05.
+                    - kld_z (float): Normal quantile of the confidence in
+                                     the bound, see kld_bound. Defaults
+                                     to 2.326 (99%).
+                    - kld_bin_size (float): Side of the square (x, y) bins,
+                                            in pixels. Defaults to 5.
         """
         self.num_particles = kwargs.get('num_particles')  # required by the autograder
         self.sigma_exp = kwargs.get('sigma_exp')  # required by the autograder
@@ -105,6 +386,23 @@ class ParticleFilter(object):
         #
         # The way to do it is:
         # self.some_parameter_name = kwargs.get('parameter_name', default_value)
+        self.resampler = kwargs.get('resampler', 'systematic')
+        if self.resampler not in RESAMPLERS:
+            raise ValueError("Unknown resampler '{}'".format(self.resampler))
+        self.ess_threshold = kwargs.get('ess_threshold', 0.5)
+        self.observation = kwargs.get('observation', 'patches')
+        if self.observation not in ('patches', 'ssd_map'):
+            raise ValueError("Unknown observation mode '{}'".format(
+                self.observation))
+        self.adaptive = kwargs.get('adaptive', False)
+        self.min_particles = kwargs.get('min_particles',
+                                        min(100, self.num_particles))
+        self.max_particles = kwargs.get('max_particles', self.num_particles)
+        if not 0 < self.min_particles <= self.max_particles:
+            raise ValueError("Need 0 < min_particles <= max_particles")
+        self.kld_epsilon = kwargs.get('kld_epsilon', 0.05)
+        self.kld_z = kwargs.get('kld_z', 2.326)
+        self.kld_bin_size = kwargs.get('kld_bin_size', 5.)
         self.frame = self.get_gray_scale(frame)
         self.template = self.get_gray_scale(template)
         # self.template = template
@@ -116,17 +414,11 @@ class ParticleFilter(object):
         self.weights = np.ones(self.num_particles) * (1/self.num_particles)  # Initialize your weights array. Read the docstring.
         # Initialize any other components you may need when designing your filter.
         self.state = np.array([0.,0.])
-        self.index = np.arange(self.num_particles)
-        self.new_particle = np.zeros_like(self.particles)
         # raise NotImplementedError
 
     def get_gray_scale(self,frame):
-    	img_temp_R = frame[:,:,0]
-    	img_temp_G = frame[:,:,1]
-    	img_temp_B = frame[:,:,2]
-    	img_temp = img_temp_R * 0.3 + img_temp_G * 0.58 + img_temp_B * 0.12
-    	return img_temp
-
+        """Returns the grayscale image of a frame, see gray_scale."""
+        return gray_scale(frame)
 
     def get_particles(self):
         """Returns the current particles state.
@@ -151,19 +443,25 @@ class ParticleFilter(object):
     def get_error_metric(self, template, frame_cutout):
         """Returns the error metric used based on the similarity measure.
 
+        frame_cutout can also be a (N, h, w) stack of cutouts, which are
+        then all compared with the template at once.
+
         Returns:
-            float: similarity value.
+            float: similarity value (numpy.array of N values for a stack).
         """
 
         m, n = template.shape
-        mse = np.sum(np.subtract(template,frame_cutout,dtype=np.float32) **2.)
+        diff = np.subtract(template, frame_cutout, dtype=np.float32)
+        mse = np.einsum('...ij,...ij->...', diff, diff)
         mse = mse / float(m*n)
-        sim = (-1) * mse / 2. / (self.sigma_exp **2.)
-        sim = np.exp(sim)
-        # print(sim)
-        return sim
+        return self.mse_similarity(mse)
         # return NotImplementedError
 
+    def mse_similarity(self, mse):
+        """Returns the similarity exp(-mse / (2 sigma_exp^2))."""
+        sim = (-1) * mse / 2. / (self.sigma_exp **2.)
+        return np.exp(sim)
+
     def resample_particles(self):
         """Returns a new set of particles
 
@@ -172,50 +470,137 @@ class ParticleFilter(object):
         Use self.num_particles and self.weights to return an array of
         resampled particles based on their weights.
 
-        See np.random.choice or np.random.multinomial.
-        
+        The particle indices are drawn with resample_indices, using the
+        self.resampler scheme. In adaptive mode, they are drawn by
+        kld_resample_indices instead, which also picks their number.
+
         Returns:
             numpy.array: particles data structure.
         """
-        
+
         sw, sh = self.template.shape
         mw, mh = self.frame.shape
         # sample new particle indices using the distribution of the weights
-        j = np.random.choice(self.index, self.num_particles, True, p=self.weights)
+        if self.adaptive:
+            j = self.kld_resample_indices()
+        else:
+            j = resample_indices(self.weights, self.num_particles,
+                                 self.resampler)
         # sample the particles using the distribution of the weights
-        # print(self.particles[0,7])
-        for i in range(self.num_particles):
-        	tep = j[i]
-        	self.new_particle[i,:] = self.particles[tep,:]
+        new_particle = self.particles[j]
 
         # clip particles in case the window goes out of the image limits
-        self.new_particle[:,0] = np.clip(self.new_particle[:,0], 0, mh - 1)
-        self.new_particle[:,1] = np.clip(self.new_particle[:,1], 0, mw - 1)
+        new_particle[:,0] = np.clip(new_particle[:,0], 0, mh - 1)
+        new_particle[:,1] = np.clip(new_particle[:,1], 0, mw - 1)
 
-        return self.new_particle
+        return new_particle
         # return NotImplementedError
 
-    
+    def kld_resample_indices(self):
+        """Returns the particle indices to resample, by KLD-sampling.
+
+        max_particles indices are drawn from the weights in random order,
+        their particles moved by the sigma_dyn dynamics noise as they will
+        be on the next frame, and binned on an (x, y) grid of kld_bin_size
+        pixels. The draws are kept up to the first count that reaches
+        kld_bound of the bins they occupy, clipped to [min_particles,
+        max_particles]. A filter locked on its target fills few bins and
+        shrinks to a small set, a filter that lost it spreads over many
+        bins and grows again.
 
-    def observe(self, img):
+        Returns:
+            numpy.array: Indices of the new particles.
+        """
+        idx = resample_indices(self.weights, self.max_particles, 'multinomial')
+        predicted = self.particles[idx] + np.random.normal(
+            0, self.sigma_dyn, (len(idx), 2))
+        bins = np.floor(predicted / self.kld_bin_size).astype(int)
+        bins -= bins.min(axis=0)
+        keys = bins[:, 0] * (bins[:, 1].max() + 1) + bins[:, 1]
+        # number of bins occupied by the first i + 1 draws
+        first = np.unique(keys, return_index=True)[1]
+        new_bin = np.zeros(len(keys), dtype=int)
+        new_bin[first] = 1
+        occupied = np.cumsum(new_bin)
+        bound = kld_bound(occupied, self.kld_epsilon, self.kld_z)
+        drawn = np.arange(1, len(keys) + 1)
+        enough = np.flatnonzero((drawn >= bound) & (drawn >= self.min_particles))
+        n = drawn[enough[0]] if len(enough) else self.max_particles
+        return idx[:n]
+
+    def effective_sample_size(self):
+        """Returns the effective sample size 1 / sum(weights^2)."""
+        return 1. / np.sum(np.square(self.weights))
+
+    def resample_if_needed(self):
+        """Resamples the particles when too few of them carry the weight.
+
+        The particles are resampled, and the weights reset to uniform, when
+        the effective sample size falls below ess_threshold times the
+        number of particles. Otherwise the weights carry over to the next
+        observation. In adaptive mode num_particles follows the size of
+        the new set.
+
+        Returns:
+            bool: Whether the particles were resampled.
+        """
+        if (self.effective_sample_size() >=
+                self.ess_threshold * len(self.weights)):
+            return False
+        self.particles = self.resample_particles()
+        self.num_particles = len(self.particles)
+        self.weights = np.ones(self.num_particles) / self.num_particles
+        return True
+
+    def observe(self, img, chunk_size=2 ** 17):
+        """Weights the particles by the similarity of their patch.
+
+        The patches of all particles are gathered from a sliding window
+        view of the frame, a chunk of particles at a time, and compared
+        with the template in one batched get_error_metric call.
+
+        In 'ssd_map' observation mode, the sum of squared differences with
+        the template is instead computed once for every position of the
+        particle cloud's bounding box (cv2.matchTemplate, TM_SQDIFF), and
+        each particle reads its value from that map. The cost then depends
+        on the spread of the particles, not on their number.
+
+        Args:
+            img (numpy.array): color BGR uint8 image of current video frame.
+            chunk_size (int): Number of patch pixels gathered at a time.
+        """
         # get patches corresponding to each particle
         mh,mw = np.shape(self.template)
         img = self.get_gray_scale(img)
         sh,sw = np.shape(img)
-        minx = (self.particles[:,0] - mw/2).astype(np.int)
-        miny = (self.particles[:,1] - mh/2).astype(np.int)
+        minx = (self.particles[:,0] - mw/2).astype(int)
+        miny = (self.particles[:,1] - mh/2).astype(int)
         minx = np.clip(minx, 0, sw - mw - 1)
         miny = np.clip(miny, 0, sh - mh - 1)
-        candidates = [img[miny[i]:miny[i]+mh, minx[i]:minx[i]+mw]
-                      for i in range(self.num_particles)]
-
-        # print(minx[0],minx[0]+mw)
 
-        # compute importance weight - similarity of each patch to the model
-        self.weights = np.array([self.get_error_metric(self.template, cand) for cand in candidates])
+        if self.observation == 'ssd_map':
+            likelihood = self.mse_similarity(
+                _ssd_mse(img, self.template, minx, miny))
+        else:
+            windows = np.lib.stride_tricks.sliding_window_view(img, (mh, mw))
+
+            # compute importance weight - similarity of each patch to the model
+            likelihood = np.empty(len(self.particles))
+            step = max(1, chunk_size // (mh * mw))
+            for start in range(0, len(self.particles), step):
+                stop = start + step
+                candidates = windows[miny[start:stop], minx[start:stop]]
+                likelihood[start:stop] = self.get_error_metric(
+                    self.template, candidates)
+
+        # weights left over from a frame without resampling are the prior
+        self.weights = self.weights * likelihood
         # normalize the weights
-        # print(np.sum(self.weights))
-        self.weights /= np.sum(self.weights)
+        total = np.sum(self.weights)
+        if total > 0:
+            self.weights /= total
+        else:
+            self.weights = likelihood / np.sum(likelihood)
 
 
     def process(self, frame):
@@ -229,6 +614,10 @@ class ParticleFilter(object):
         image. This means you should address particles that are close to the
         image borders.
 
+        The state is the weighted mean of the particles. The particles are
+        only resampled when their effective sample size is low, see
+        resample_if_needed.
+
         Args:
             frame (numpy.array): color BGR uint8 image of current video frame,
                                  values in [0, 255].
@@ -238,9 +627,8 @@ class ParticleFilter(object):
         """
         self.particles += np.random.normal(0, self.sigma_dyn, self.particles.shape)
         self.observe(frame)
-        self.particles = self.resample_particles()
-        state_idx = np.random.choice(self.index, 1, p=self.weights)
-        self.state = self.particles[state_idx,:]
+        self.state = np.dot(self.weights, self.particles)
+        self.resample_if_needed()
         
 
 
@@ -275,43 +663,8 @@ class ParticleFilter(object):
                                     particle filter.
         """
 
-        def distance(pa,pb,a,b):
-        	dis = np.sqrt((pa-a)**2 + (pb-b)**2)
-        	return dis
-
-        # frame_out = np.copy(frame_in)
-        m,n = np.shape(self.template)
-
-        x_weighted_mean = 0
-        y_weighted_mean = 0
-
-        # print(self.particles[0, 0], self.weights[0])
-
-        for i in range(self.num_particles):
-            x_weighted_mean += self.particles[i,0] * self.weights[i]
-            y_weighted_mean += self.particles[i,1] * self.weights[i]
-            cv2.circle(frame_in, (int(self.particles[i,0]), int(self.particles[i,1])), 2, (200, 0, 0), -1)
-
-        cv2.rectangle(frame_in, (int(x_weighted_mean) - n // 2, int(y_weighted_mean) - m // 2),
-                         (int(x_weighted_mean) + n // 2, int(y_weighted_mean) + m // 2), (0, 200, 0), 2)
-
-        # temp = np.linalg.norm(self.particles - (x_weighted_mean,y_weighted_mean))
-        # dis_weighted_mean = np.sum(temp * self.weights.reshape((-1,1)))
-        # print(self.particles[0,0],self.particles[190,0])
-        dis_weighted_mean = 0
-        for i in range(self.num_particles):
-        	temp = distance(self.particles[i,0],self.particles[i,1],x_weighted_mean,y_weighted_mean) 
-        	dis_weighted_mean += temp * self.weights[i]
-        # print(dis_weighted_mean)
-
-        cv2.circle(frame_in, (int(x_weighted_mean), int(y_weighted_mean)), int(dis_weighted_mean), (200, 200, 200), 2)
-
-        # Complete the rest of the code as instructed.
-        # cv2.imshow('test',frame_in)
-        # cv2.waitKey(0)
-        # frame_in = np.copy(frame_out)
-        return frame_in
-        # raise NotImplementedError
+        return render_particles(frame_in, self.particles, self.weights,
+                                np.shape(self.template))
 
 
 class AppearanceModelPF(ParticleFilter):
@@ -344,8 +697,8 @@ class AppearanceModelPF(ParticleFilter):
     	ind = np.argmax(self.weights)
     	x_weighted_mean = self.particles[ind,0]
     	y_weighted_mean = self.particles[ind,1]
-    	minx = (x_weighted_mean - mw/2).astype(np.int)
-    	miny = (y_weighted_mean - mh/2).astype(np.int)
+    	minx = int(x_weighted_mean - mw/2)
+    	miny = int(y_weighted_mean - mh/2)
     	minx = np.clip(minx, 0, sw - mw - 1)
     	miny = np.clip(miny, 0, sh - mh - 1)
     	# print(minx)
@@ -375,7 +728,7 @@ class AppearanceModelPF(ParticleFilter):
         frame = ParticleFilter.get_gray_scale(self,frame)
         if self.alpha > 0:
         	self.update_model(frame)
-        self.particles = ParticleFilter.resample_particles(self)
+        self.resample_if_needed()
         # print(self.state)
         
         # raise NotImplementedError
@@ -429,7 +782,7 @@ class MDParticleFilter(AppearanceModelPF):
             pass
         else:
             self.particles += np.random.normal(0, self.sigma_dyn, self.particles.shape)
-            self.particles = ParticleFilter.resample_particles(self)
+            self.resample_if_needed()
         	# print(std)
         ratio = (self.beta)**(self.count)
         self.template = cv2.resize(self.template_not_change, (0,0), fx=ratio, fy=ratio)
@@ -437,4 +790,212 @@ class MDParticleFilter(AppearanceModelPF):
         # raise NotImplementedError
 
 
+class MultiTargetPF(object):
+    """Particle filters of several targets, run as one batch.
+
+    The particles of every target are stacked in one (targets, N, 2) array
+    and their weights in one (targets, N) array. Each frame is converted to
+    grayscale once. The patches of the targets that share a template size
+    are gathered together and compared with their templates in one batched
+    operation, and all targets are resampled with one resample_indices
+    call, so tracking many targets costs about as much as one large filter.
+    Targets are added and removed as they enter and leave the video.
+
+    Args:
+        frame (numpy.array): color BGR uint8 image of initial video frame.
+        kwargs: keyword arguments of ParticleFilter (num_particles,
+                sigma_exp, sigma_dyn, resampler, ess_threshold,
+                observation), num_particles being per target, and:
+                - alpha (float): Appearance model update rate, see
+                                 AppearanceModelPF. Defaults to 0 (fixed
+                                 templates).
+
+    Attributes:
+        particles (numpy.array): (targets, N, 2) particles (x, y).
+        weights (numpy.array): (targets, N) normalized weights.
+        templates (list): Grayscale template of each target.
+        target_ids (list): Id of each target, as returned by add_target.
+        state (numpy.array): (targets, 2) weighted mean of each target's
+                             particles.
+    """
+
+    def __init__(self, frame, **kwargs):
+        self.num_particles = kwargs.get('num_particles')
+        self.sigma_exp = kwargs.get('sigma_exp')
+        self.sigma_dyn = kwargs.get('sigma_dyn')
+        self.alpha = kwargs.get('alpha', 0.)
+        self.resampler = kwargs.get('resampler', 'systematic')
+        if self.resampler not in RESAMPLERS:
+            raise ValueError("Unknown resampler '{}'".format(self.resampler))
+        self.ess_threshold = kwargs.get('ess_threshold', 0.5)
+        self.observation = kwargs.get('observation', 'patches')
+        if self.observation not in ('patches', 'ssd_map'):
+            raise ValueError("Unknown observation mode '{}'".format(
+                self.observation))
+        self.frame_shape = np.shape(frame)[:2]
+        self.particles = np.zeros((0, self.num_particles, 2))
+        self.weights = np.zeros((0, self.num_particles))
+        self.templates = []
+        self.target_ids = []
+        self.state = np.zeros((0, 2))
+        self.next_id = 0
+
+    get_gray_scale = ParticleFilter.get_gray_scale
+    mse_similarity = ParticleFilter.mse_similarity
+
+    def add_target(self, template):
+        """Starts tracking a target.
+
+        Its particles are spread uniformly over the frame, like in
+        ParticleFilter.
 
+        Args:
+            template (numpy.array): color BGR uint8 image of the target.
+
+        Returns:
+            int: Id of the target.
+        """
+        m, n = self.frame_shape
+        particles = np.stack((np.random.choice(n, self.num_particles, True),
+                              np.random.choice(m, self.num_particles, True)),
+                             axis=-1).astype(float)
+        self.particles = np.concatenate((self.particles, particles[None]))
+        self.weights = np.concatenate(
+            (self.weights, np.ones((1, self.num_particles)) / self.num_particles))
+        self.state = np.concatenate((self.state, np.dot(self.weights[-1:],
+                                                        particles)))
+        self.templates.append(self.get_gray_scale(template))
+        self.target_ids.append(self.next_id)
+        self.next_id += 1
+        return self.target_ids[-1]
+
+    def remove_target(self, target_id):
+        """Stops tracking the target with the given id."""
+        t = self.target_ids.index(target_id)
+        self.particles = np.delete(self.particles, t, axis=0)
+        self.weights = np.delete(self.weights, t, axis=0)
+        self.state = np.delete(self.state, t, axis=0)
+        del self.templates[t]
+        del self.target_ids[t]
+
+    def observe(self, img, chunk_size=2 ** 17):
+        """Weights the particles of every target.
+
+        Args:
+            img (numpy.array): Grayscale frame.
+            chunk_size (int): Number of patch pixels gathered at a time.
+        """
+        img = np.asarray(img, dtype=np.float32)
+        sh, sw = img.shape
+        likelihood = np.empty(self.weights.shape)
+        by_shape = {}
+        for t, template in enumerate(self.templates):
+            by_shape.setdefault(np.shape(template), []).append(t)
+
+        for (mh, mw), targets in by_shape.items():
+            targets = np.array(targets)
+            minx = (self.particles[targets, :, 0] - mw/2).astype(int)
+            miny = (self.particles[targets, :, 1] - mh/2).astype(int)
+            minx = np.clip(minx, 0, sw - mw - 1)
+            miny = np.clip(miny, 0, sh - mh - 1)
+
+            if self.observation == 'ssd_map':
+                for k, t in enumerate(targets):
+                    likelihood[t] = self.mse_similarity(_ssd_mse(
+                        img, self.templates[t], minx[k], miny[k]))
+                continue
+
+            windows = np.lib.stride_tricks.sliding_window_view(img, (mh, mw))
+            templates = np.array([self.templates[t] for t in targets],
+                                 dtype=np.float32)
+            # whole targets per chunk, or a slice of one target's particles
+            per_chunk = max(1, chunk_size // (mh * mw))
+            target_step = max(1, per_chunk // self.num_particles)
+            particle_step = min(per_chunk, self.num_particles)
+            for start in range(0, len(targets), target_step):
+                rows = slice(start, start + target_step)
+                for first in range(0, self.num_particles, particle_step):
+                    cols = slice(first, first + particle_step)
+                    diff = (windows[miny[rows, cols], minx[rows, cols]] -
+                            templates[rows, None])
+                    mse = (np.einsum('...ij,...ij->...', diff, diff) /
+                           float(mh*mw))
+                    likelihood[targets[rows], cols] = self.mse_similarity(mse)
+
+        # weights left over from a frame without resampling are the prior
+        weights = self.weights * likelihood
+        total = np.sum(weights, axis=1, keepdims=True)
+        fallback = likelihood / np.sum(likelihood, axis=1, keepdims=True)
+        self.weights = np.where(total > 0, weights / np.maximum(total, 1e-300),
+                                fallback)
+
+    def update_models(self, img):
+        """Blends each template with the patch of its best particle.
+
+        Args:
+            img (numpy.array): Grayscale frame.
+        """
+        sh, sw = np.shape(img)
+        best = np.argmax(self.weights, axis=1)
+        for t, template in enumerate(self.templates):
+            mh, mw = np.shape(template)
+            x, y = self.particles[t, best[t]]
+            minx = int(np.clip(int(x - mw/2), 0, sw - mw - 1))
+            miny = int(np.clip(int(y - mh/2), 0, sh - mh - 1))
+            patch = img[miny:miny+mh, minx:minx+mw]
+            if patch.shape == template.shape:
+                self.templates[t] = (self.alpha * patch +
+                                     (1. - self.alpha) * template)
+
+    def resample_if_needed(self):
+        """Resamples the targets whose effective sample size is low.
+
+        See ParticleFilter.resample_if_needed.
+
+        Returns:
+            numpy.array: Whether each target was resampled.
+        """
+        ess = 1. / np.sum(np.square(self.weights), axis=1)
+        low = ess < self.ess_threshold * self.num_particles
+        if np.any(low):
+            idx = resample_indices(self.weights[low], self.num_particles,
+                                   self.resampler)
+            particles = np.take_along_axis(self.particles[low],
+                                           idx[..., None], axis=1)
+            # clip particles in case the window goes out of the image limits
+            particles[..., 0] = np.clip(particles[..., 0], 0,
+                                        self.frame_shape[1] - 1)
+            particles[..., 1] = np.clip(particles[..., 1], 0,
+                                        self.frame_shape[0] - 1)
+            self.particles[low] = particles
+            self.weights[low] = 1. / self.num_particles
+        return low
+
+    def process(self, frame):
+        """Processes a video frame and updates every target.
+
+        Args:
+            frame (numpy.array): color BGR uint8 image of current video frame,
+                                 values in [0, 255].
+
+        Returns:
+            None.
+        """
+        img = self.get_gray_scale(frame)
+        self.particles += np.random.normal(0, self.sigma_dyn,
+                                           self.particles.shape)
+        self.observe(img)
+        self.state = np.einsum('tn,tnc->tc', self.weights, self.particles)
+        if self.alpha > 0:
+            self.update_models(img)
+        self.resample_if_needed()
+
+    def render(self, frame_in):
+        """Draws every target's particles, window and spread.
+
+        See ParticleFilter.render.
+        """
+        for t, template in enumerate(self.templates):
+            render_particles(frame_in, self.particles[t], self.weights[t],
+                             np.shape(template))
+        return frame_in